@@ -5,7 +5,7 @@ Author: Lucas David -- <lucasolivdavid@gmail.com>
 Licence: MIT License 2016 (c)
 
 """
-from .base import load_pickle_data, group_by_paintings
+from .base import load_pickle_data, iter_pickle_data, group_by_paintings, index_patches, EmbeddingsWriter, is_columnar_data
 from .painter_by_numbers import PainterByNumbers
 from .paintings91 import Paintings91
 from .van_gogh import VanGogh
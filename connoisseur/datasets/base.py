@@ -5,96 +5,395 @@ Licence: MIT License 2016 (c)
 
 """
 
+import io
 import itertools
+import json
 import os
 import pickle
 import shutil
 import tarfile
+import tempfile
+import uuid
 import zipfile
-from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from math import ceil
-from urllib import request
 
 import numpy as np
-import tensorflow as tf
-from PIL import ImageOps
-from keras.preprocessing.image import img_to_array, load_img
-from skimage import feature
+import pandas as pd
+from keras.preprocessing.image import img_to_array
 from sklearn.preprocessing import LabelEncoder
 from sklearn.utils import check_random_state
 
-from ..utils.image import PaintingEnhancer
+from ..utils.catalog import catalog_file_name, is_outdated, load_catalog
+from ..utils.download import download
+from ..utils.image import (PaintingEnhancer, load_img, pad_to_patch_size, patch_probabilities,
+                           patch_starting_points, tiled_patch_starting_points)
+from ..utils.manifest import ExtractionManifest
+from ..utils.ragged import RaggedArray
+from ..utils.shards import INDEX_FILE, PatchShardWriter, is_sharded, save_index
+from ..utils.splits import SplitManifest, painting_of, split_file_name
+
+
+def _columnar_file_name(data_dir, phase, key, layer=None):
+    return os.path.join(data_dir, '.'.join(filter(None, (phase, key, layer))) + '.npy')
+
+
+def _columnar_layers(data_dir, phase):
+    prefix = '%s.data.' % phase
+    return sorted(f[len(prefix):-len('.npy')] for f in os.listdir(data_dir)
+                  if f.startswith(prefix) and f.endswith('.npy'))
+
+
+def is_columnar_data(data_dir, phase):
+    """Check whether the embeddings of `phase` were saved by an `EmbeddingsWriter`."""
+    return os.path.exists(_columnar_file_name(data_dir, phase, 'names'))
+
+
+class EmbeddingsWriter:
+    """Columnar Embeddings Writer.
+
+    Writes the embeddings of a phase into one `.npy` file per layer
+    (`{phase}.data.{layer}.npy`), plus the `{phase}.target.npy` and
+    `{phase}.names.npy` index files. Layer files are allocated on the
+    first write and filled in place through memory-maps, hence writing
+    takes constant memory. `load_pickle_data` reads them back with
+    `mmap_mode='r'`.
+
+    The names file is only written when the writer is closed, marking the
+    phase as completely embedded.
+
+    Parameters
+    ----------
+    data_dir: str, directory in which the files are written.
+    phase: str, phase being embedded (e.g. 'train', 'test').
+    names: array-like, names of all samples, in the order they are written.
+    """
+
+    def __init__(self, data_dir, phase, names):
+        self.data_dir = data_dir
+        self.phase = phase
+        self.names = np.asarray(names, dtype=str)
+        self.n_samples = len(self.names)
+
+        self.data_ = {}
+        self.target_ = None
+
+    def _open(self, key, layer, sample):
+        return np.lib.format.open_memmap(
+            _columnar_file_name(self.data_dir, self.phase, key, layer),
+            mode='w+', dtype=sample.dtype,
+            shape=(self.n_samples,) + sample.shape[1:])
+
+    def write(self, start, data, target):
+        """Write a batch of embeddings.
+
+        :param start: int, index of the first sample in the batch.
+        :param data: dict, mapping each layer to its batch of outputs.
+        :param target: array-like, labels of the samples in the batch.
+        """
+        target = np.asarray(target)
+        end = start + len(target)
+
+        for l, o in data.items():
+            if l not in self.data_:
+                self.data_[l] = self._open('data', l, o)
+            self.data_[l][start:end] = o
+
+        if self.target_ is None:
+            self.target_ = self._open('target', None, target)
+        self.target_[start:end] = target
+
+    def close(self):
+        for m in itertools.chain(self.data_.values(), (self.target_,)):
+            if m is not None:
+                m.flush()
+        self.data_, self.target_ = {}, None
+
+        np.save(_columnar_file_name(self.data_dir, self.phase, 'names'), self.names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+
+def _as_classes(classes):
+    if isinstance(classes, int):
+        classes = range(classes)
+    return list(classes)
+
+
+def _filter_classes(d, keys, classes):
+    s = np.in1d(d['target'], classes)
+    for k in keys:
+        if k == 'data':
+            for l in d[k].keys():
+                d[k][l] = d[k][l][s]
+        else:
+            d[k] = d[k][s]
+    return d
+
+
+def _load_columnar_data(data_dir, phase, keys, layers, classes=None):
+    s = slice(None)
+
+    if classes is not None:
+        # Only the target index is read to find the selected samples.
+        # Samples are stored sorted by label, so selections are usually a
+        # contiguous range, which is kept as a zero-copy view.
+        target = np.load(_columnar_file_name(data_dir, phase, 'target'), mmap_mode='r')
+        s, = np.where(np.in1d(target, classes))
+        if len(s) and s[-1] - s[0] + 1 == len(s):
+            s = slice(s[0], s[-1] + 1)
+
+    d = {}
+    for k in keys:
+        if k == 'data':
+            d[k] = {l: np.load(_columnar_file_name(data_dir, phase, k, l), mmap_mode='r')[s]
+                    for l in layers or _columnar_layers(data_dir, phase)}
+        else:
+            d[k] = np.load(_columnar_file_name(data_dir, phase, k), mmap_mode='r')[s]
+    return d
+
+
+def _chunk_index_file_name(data_dir, phase, chunk):
+    return os.path.join(data_dir, '%s.%i.classes.npy' % (phase, chunk))
+
+
+def _chunk_has_classes(data_dir, phase, chunk, classes):
+    """Check the persisted index of a chunk for any of the `classes`.
+
+    Chunks without an index are assumed to contain them.
+    """
+    file_name = _chunk_index_file_name(data_dir, phase, chunk)
+    return not os.path.exists(file_name) or np.in1d(np.load(file_name), classes).any()
+
+
+def _read_pickled_chunk(data_dir, phase, chunk, layers, classes=None):
+    file_name = os.path.join(data_dir, '%s.%i.pickle' % (phase, chunk))
+
+    with open(file_name, 'rb') as file:
+        d = pickle.load(file)
+
+    index_file_name = _chunk_index_file_name(data_dir, phase, chunk)
+    if not os.path.exists(index_file_name):
+        try:
+            np.save(index_file_name, np.unique(d['target']))
+        except OSError:
+            # Read-only data directory. Chunks won't be skipped.
+            pass
+
+    if layers:
+        d['data'] = {l: d['data'][l] for l in layers}
+    if classes is not None:
+        d = _filter_classes(d, d.keys(), classes)
+    return d
+
+
+def _existing_chunks(data_dir, phase, chunks):
+    for c in chunks:
+        file_name = os.path.join(data_dir, '%s.%i.pickle' % (phase, c))
+
+        if os.path.exists(file_name):
+            yield c
+        elif c > 0:
+            print('skipping', file_name)
+        else:
+            raise ValueError('%s data cannot be found at %s.' % (phase, data_dir))
+
+
+def _load_pickled_data(data_dir, phase, keys, chunks, layers, classes=None):
+    chunks = list(_existing_chunks(data_dir, phase, chunks))
+
+    if classes is not None:
+        # Chunks without any of the selected classes are not read.
+        selected = [c for c in chunks if _chunk_has_classes(data_dir, phase, c, classes)]
+        chunks = selected or chunks[:1]
+
+    d = {k: [] for k in keys}
+
+    for c in chunks:
+        chunk = _read_pickled_chunk(data_dir, phase, c, layers, classes)
+        for k in keys:
+            d[k].append(chunk[k])
+
+    for k in keys:
+        if k == 'data':
+            # Merges chunks of each layer output.
+            d[k] = {l: np.concatenate([x[l] for x in d[k]]) for l in d[k][0]}
+        else:
+            # Merges chunks integrally.
+            d[k] = np.concatenate(d[k])
+    return d
+
+
+def _iter_pickled_chunks(data_dir, phase, keys, chunks, layers, classes=None):
+    for c in _existing_chunks(data_dir, phase, chunks):
+        if classes is None or _chunk_has_classes(data_dir, phase, c, classes):
+            chunk = _read_pickled_chunk(data_dir, phase, c, layers)
+            yield {k: chunk[k] for k in keys}
 
 
 def load_pickle_data(data_dir, phases=None, keys=None, chunks=(0,),
                      layers=None, classes=None):
+    """Load embeddings previously saved onto the disk.
+
+    Phases written by an `EmbeddingsWriter` are memory-mapped, and the
+    arrays returned are read-only views over the files (`chunks` is then
+    ignored). Otherwise, the `{phase}.{chunk}.pickle` files are unpickled
+    and merged.
+
+    The `classes` filter is applied before any merging. The classes
+    within each pickled chunk are indexed in `{phase}.{chunk}.classes.npy`
+    the first time it is read, and chunks without any of the selected
+    classes are skipped in later loads.
+
+    :param data_dir: str, directory containing the embeddings.
+    :param phases: list of phases to load.
+    :param keys: list of keys to load, from 'data', 'target' and 'names'.
+    :param chunks: list of pickled chunks to load.
+    :param layers: list of layers to load. All layers are loaded if None.
+    :param classes: int or list of classes to keep.
+    :return: dict, mapping each phase to a tuple with the values of `keys`.
+    """
     phases = phases or ('train', 'valid', 'test')
     keys = keys or ('data', 'target', 'names')
 
-    data = {p: {k: [] for k in keys} for p in phases}
-
-    for p in phases:
-        for c in chunks:
-            file_name = os.path.join(data_dir, '%s.%i.pickle' % (p, c))
-
-            if os.path.exists(file_name):
-                with open(file_name, 'rb') as file:
-                    d = pickle.load(file)
-                    for k in keys:
-                        data[p][k].append(d[k])
-            elif c > 0:
-                print('skipping', file_name)
-            else:
-                raise ValueError('%s data cannot be found at %s.' % (p, data_dir))
+    if classes is not None:
+        classes = _as_classes(classes)
 
-        _layers = layers or data[p]['data'][0].keys()
+    data = {}
 
-        for k in keys:
-            if k == 'data':
-                # Merges chunks of each layer output.
-                data[p][k] = {l: np.concatenate([x[l] for x in data[p][k]]) for l in _layers}
-            else:
-                # Merges chunks integrally.
-                data[p][k] = np.concatenate(data[p][k])
-
-        if classes is not None:
-            if isinstance(classes, int):
-                classes = range(classes)
-            classes = list(classes)
-
-            s = np.in1d(data[p]['target'], classes)
-            for k in keys:
-                if k == 'data':
-                    for l in data[p][k].keys():
-                        data[p][k][l] = data[p][k][l][s]
-                else:
-                    data[p][k] = data[p][k][s]
+    for p in phases:
+        if is_columnar_data(data_dir, p):
+            data[p] = _load_columnar_data(data_dir, p, keys, layers, classes)
+        else:
+            data[p] = _load_pickled_data(data_dir, p, keys, chunks, layers, classes)
 
         data[p] = tuple(data[p][k] for k in keys)
     return data
 
 
+def iter_pickle_data(data_dir, phase='train', keys=None, chunks=(0,),
+                     layers=None, classes=None, block_size=None):
+    """Iterate over the embeddings of a phase, one block at a time.
+
+    Only a single block is held in memory at any moment, which allows
+    single-pass consumers to process phases larger than the memory.
+
+    :param block_size: int, maximum number of samples in each block.
+        If None, pickled phases are yielded one chunk at a time and
+        columnar phases are yielded at once, as memory-mapped views.
+    :return: a generator of tuples with the values of `keys`, with the
+        `layers` and `classes` filters applied to each block. Blocks left
+        empty by the `classes` filter are not yielded.
+
+    See `load_pickle_data` for the description of the remaining parameters.
+    """
+    keys = keys or ('data', 'target', 'names')
+
+    if classes is not None:
+        classes = _as_classes(classes)
+
+    if is_columnar_data(data_dir, phase):
+        parts = [_load_columnar_data(data_dir, phase, keys, layers)]
+    else:
+        parts = _iter_pickled_chunks(data_dir, phase, keys, chunks, layers, classes)
+
+    for d in parts:
+        n_samples = len(d[keys[0]] if keys[0] != 'data' else next(iter(d['data'].values())))
+        _block_size = block_size or n_samples
+
+        for start in range(0, n_samples, _block_size):
+            block = {k: ({l: v[start:start + _block_size] for l, v in d[k].items()}
+                         if k == 'data' else d[k][start:start + _block_size])
+                     for k in keys}
+
+            if classes is not None:
+                block = _filter_classes(block, keys, classes)
+
+                if not len(block['target']):
+                    continue
+
+            yield tuple(block[k] for k in keys)
+
+
 def group_by_paintings(*arrays,
                        names: np.ndarray,
-                       max_patches: int = None):
-    # Aggregate test patches by their respective paintings.
-    _x, _y, _names = [], [], []
-    outputs = [[] for _ in arrays]
+                       max_patches: int = None,
+                       return_index: bool = False):
+    """Aggregate patches by their respective paintings.
+
+    Patches are grouped by sorting their painting names, which takes
+    O(n log n) time. Paintings are returned in lexicographical order and
+    the patches within each painting keep their original order.
+
+    :param arrays: arrays shaped as (patches, ...), which will be grouped.
+    :param names: array of patch names, following the `{painting}-{id}`
+        convention.
+    :param max_patches: int, maximum number of patches kept per painting.
+    :param return_index: bool, whether to also return a dict mapping each
+        painting name to its position in the grouped arrays.
+    :return: the grouped arrays, shaped as (paintings, patches, ...),
+        followed by the painting names and, optionally, the index.
+        If paintings have different numbers of patches, the grouped arrays
+        are `RaggedArray`s instead.
+    """
+    names = np.asarray(names, dtype=str)
     # Remove patches indices, leaving just the painting name.
-    clipped_names = np.array(['-'.join(n.split('-')[:-1]) for n in names])
-    for name in set(clipped_names):
-        s = clipped_names == name
+    clipped_names = np.char.rpartition(names, '-')[:, 0] if len(names) else names
+    paintings, groups = np.unique(clipped_names, return_inverse=True)
+
+    order = np.argsort(groups, kind='mergesort')
+    counts = np.bincount(groups, minlength=len(paintings))
+
+    if max_patches:
+        positions = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+        order = order[positions < max_patches]
+        counts = np.minimum(counts, max_patches)
+
+    outputs = []
+    for a in arrays:
+        a = np.asarray(a)[order]
+
+        n_patches = counts[0] if len(counts) else 0
+
+        if (counts == n_patches).all():
+            a = a.reshape((len(counts), n_patches) + a.shape[1:])
+        else:
+            a = RaggedArray.from_lengths(a, counts)
+        outputs.append(a)
+
+    outputs.append(paintings)
+
+    if return_index:
+        outputs.append({n: i for i, n in enumerate(paintings.tolist())})
+
+    return outputs
+
+
+def index_patches(patches_names):
+    """Index patches by the painting they were extracted from.
 
-        indices, = np.where(s)
-        if max_patches and len(indices) > max_patches:
-            indices = indices[:max_patches]
+    Names are parsed once, following the `{painting}-{id}.{ext}` convention,
+    which gives exact lookups (e.g. `vg_1` does not match `vg_12-3.jpg`).
 
-        for _i, _o in zip(arrays, outputs):
-            _o.append(_i[indices])
+    :param patches_names: iterable of patch file names.
+    :return: dict, mapping each painting name to the list of its patches'
+        names, sorted by patch id.
+    """
+    index = defaultdict(list)
 
-        _names.append(clipped_names[indices][0])
+    for n in patches_names:
+        painting, _, patch_id = os.path.splitext(n)[0].rpartition('-')
+        index[painting].append((len(patch_id), patch_id, n))
 
-    return [np.asarray(o) for o in outputs] + [np.asarray(_names)]
+    # Sorting by (length, id) orders numerical ids naturally.
+    return {painting: [n for _, _, n in sorted(patches)]
+            for painting, patches in index.items()}
 
 
 def _load_patch_coroutine(options):
@@ -104,13 +403,39 @@ def _load_patch_coroutine(options):
             load_img(options['name'])))
 
 
+def _shared_array(shape, dtype, directory=None):
+    """Create a memory-mapped array which worker processes can write into.
+
+    The array is backed by shared memory (`/dev/shm`) if it has room for
+    it. Otherwise (e.g. Docker containers default `/dev/shm` to 64MB), it
+    falls back to the disk's temporary directory.
+
+    :param directory: str, where the array is created. Overrides the
+        choice above.
+    :return: str, the path of the `.npy` file backing the array.
+    """
+    if directory is None:
+        shm = '/dev/shm'
+        n_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+        if os.path.isdir(shm):
+            stat = os.statvfs(shm)
+            if stat.f_bavail * stat.f_frsize > n_bytes:
+                directory = shm
+
+    fd, path = tempfile.mkstemp(suffix='.npy', dir=directory)
+    os.close(fd)
+    np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape).flush()
+    return path
+
+
 def _load_patches_coroutine(args):
-    name, patch_size, n_patches, augmentations, random_state = args
+    name, patch_size, n_patches, augmentations, random_state, output, index = args
     random_state = check_random_state(random_state)
     img = load_img(name)
-    patches = []
+    patches = np.load(output, mmap_mode='r+')
     enhancer = PaintingEnhancer(augmentations)
-    for _ in range(n_patches):
+    for i in range(n_patches):
         start = (random_state.rand(2) *
                  (img.width - patch_size[0],
                   img.height - patch_size[1])).astype('int')
@@ -118,70 +443,202 @@ def _load_patches_coroutine(args):
         patch = img.crop((start[0], start[1], end[0], end[1]))
 
         patch = enhancer.process(patch)
-        patches.append(img_to_array(patch))
+        patches[index, i] = np.asarray(patch, dtype=np.uint8)
 
-    return patches
+    patches.flush()
+
+
+_open_archives = {}
+
+
+def _is_zip(archive_name):
+    return os.path.splitext(archive_name)[1] == '.zip'
+
+
+def _archive_names(archive_name):
+    """The names of the files in an archive, in the order they are stored.
+
+    Tar archives are streamed, being fully decompressed to be listed.
+    """
+    if _is_zip(archive_name):
+        with zipfile.ZipFile(archive_name) as archive:
+            return [m.filename for m in archive.infolist() if not m.filename.endswith('/')]
+
+    with tarfile.open(archive_name, 'r|*') as archive:
+        return [m.name for m in archive if m.isfile()]
+
+
+def _read_archive_member(archive_name, member):
+    """Read `member` from a zip archive, which is opened once per process."""
+    if archive_name not in _open_archives:
+        _open_archives[archive_name] = zipfile.ZipFile(archive_name, 'r')
+    return _open_archives[archive_name].read(member)
+
+
+def _close_archives():
+    for archive in _open_archives.values():
+        archive.close()
+    _open_archives.clear()
+
+
+LAYOUT_LINKS = ('hard', 'symbolic', 'move')
+
+
+def _layout_label_folder(args):
+    """Place the files of a label into its folder.
+
+    Files already in the folder are skipped, so interrupted layouts are
+    resumed.
+
+    :return: (placed, missing), the number of files placed and the names
+        of the ones not found in `source`.
+    """
+    source, folder, files, link = args
+    os.makedirs(folder, exist_ok=True)
+    placed, missing = 0, []
+
+    for f in files:
+        src, dst = os.path.join(source, f), os.path.join(folder, f)
+        if os.path.lexists(dst):
+            continue
+        if not os.path.exists(src):
+            missing.append(f)
+            continue
+
+        if link == 'hard':
+            os.link(src, dst)
+        elif link == 'symbolic':
+            # Relative, so the tree can be moved around.
+            os.symlink(os.path.relpath(src, folder), dst)
+        else:
+            os.rename(src, dst)
+        placed += 1
+
+    return placed, missing
 
 
 def _save_image_patches_coroutine(**options):
-    image = load_img(options['name'])
-    border = np.array(options['patch_size']) - image.size
+    archive = options.get('archive')
+    data = options.get('data')
+
+    if data is not None:
+        image = load_img(io.BytesIO(data))
+    elif archive:
+        image = load_img(io.BytesIO(_read_archive_member(archive, options['name'])))
+    else:
+        image = load_img(options['name'])
     painting_name = os.path.splitext(os.path.basename(options['name']))[0]
     patches_path = options['patches_path']
-
-    if np.any(border > 0):
-        # The image is smaller than the patch size in any dimension.
-        # Pad it to make sure we can extract at least one patch.
-        border = np.ceil(border.clip(0, border.max()) / 2).astype(np.int)
-        image = ImageOps.expand(image, border=tuple(border))
+    random_state = options.get('random_state', np.random)
 
     mode = options['mode']
     patch_size = options.get('patch_size', [256, 256])
     n_patches = options['n_patches']
+    pool_size = options.get('pool_size', 1)
 
-    if mode in ('min-gradient', 'max-gradient'):
-        gray_image = image.convert('L')
-        gray_tensor = img_to_array(gray_image).squeeze(-1)
-        e = feature.canny(gray_tensor, low_threshold=options['low_threshold'], use_quantiles=True).astype(np.float)
+    max_pixels = options.get('max_pixels')
 
-        pool_size = options.get('pool_size', 2)
-        x, y = options['tensors']
+    image = pad_to_patch_size(image, patch_size)
+    p = None
 
-        p = y.eval(feed_dict={x: e.reshape((1,) + e.shape + (1,))})
-        p = p.squeeze((0, -1))
+    if (mode in ('min-gradient', 'max-gradient') and
+            max_pixels and image.width * image.height > max_pixels):
+        starting_points = tiled_patch_starting_points(image, mode, patch_size, n_patches,
+                                                      max_pixels=max_pixels,
+                                                      random_state=random_state,
+                                                      low_threshold=options['low_threshold'],
+                                                      pool_size=pool_size)
+    else:
+        if mode in ('min-gradient', 'max-gradient'):
+            p = patch_probabilities(image, mode, patch_size,
+                                    low_threshold=options['low_threshold'],
+                                    pool_size=pool_size,
+                                    tensors=options.get('tensors'))
 
-        p = np.exp(p / p.sum())
-        p /= p.sum()
+        starting_points = patch_starting_points(image, mode, patch_size, n_patches,
+                                                random_state=random_state,
+                                                p=p, pool_size=pool_size)
+    writer = options.get('writer')
+    extracted = 0
 
-        if mode == 'min-gradient':
-            p = 1 - p
-            p /= p.sum()
+    for patch_id, (s_w, s_h) in enumerate(starting_points):
+        patch = image.crop((s_w, s_h, s_w + patch_size[0], s_h + patch_size[1]))
 
-        c = np.random.choice(np.arange(np.product(p.shape)), size=(n_patches, 1), p=p.flatten())
-        c = np.concatenate((c // p.shape[1], c % p.shape[1]), axis=-1).astype(np.int)
-        c += np.array(patch_size) // (2 * pool_size)  # restore sizes before convolution
-        c *= pool_size  # restore sizes before max_pooling2d
-        c -= np.array(patch_size) // 2  # center selected pixels
+        if writer is None:
+            patch.save(os.path.join(patches_path, '%s-%i.jpg' % (painting_name, patch_id)))
+        else:
+            writer.write(painting_name, patch_id, options['label'], patch)
+        extracted += 1
 
-        starting_points = np.array([c[:, 1], c[:, 0]]).T
+    return extracted
 
-    elif mode in ('random', 'balanced'):
-        starting_points = (
-            np.random.rand(n_patches, 2)
-            * (image.width - patch_size[0], image.height - patch_size[1])
-        ).astype(np.int)
 
-    elif mode == 'all':
-        d_widths = list(range(0, image.width - patch_size[0] + 1, patch_size[0]))
-        d_heights = list(range(0, image.height - patch_size[1] + 1, patch_size[1]))
-        starting_points = itertools.product(d_widths, d_heights)
-    else:
-        raise ValueError('unknown mode %s' % mode)
+def _extraction_params(options, n_patches):
+    """The parameters which determine the patches extracted from a painting."""
+    params = {k: options.get(k) for k in ('mode', 'patch_size', 'low_threshold',
+                                          'pool_size', 'max_pixels', 'output', 'backend')}
+    return ExtractionManifest.normalize(dict(params, n_patches=n_patches))
 
-    for patch_id, (s_w, s_h) in enumerate(starting_points):
-        (image
-            .crop((s_w, s_h, s_w + patch_size[0], s_h + patch_size[1]))
-            .save(os.path.join(patches_path, '%s-%i.jpg' % (painting_name, patch_id))))
+
+def _save_patches_shard_coroutine(args):
+    """Extract the patches of a shard of samples, in a worker process.
+
+    Each painting is recorded in the extraction manifest of
+    `options['phase_path']` once its patches are completely written.
+    If `options['archive']` is given, paintings are read from this archive
+    and their names are the names of its members.
+
+    :param args: tuple (samples, options, seed, shard_id), where `samples`
+        is a list of (name, label, patches_path, n_patches) tuples and `seed`
+        initializes the random state shared by all samples in the shard.
+        Samples may carry a fifth element: the encoded painting, read by
+        the parent process from a streamed archive.
+        If `options['output'] == 'shards'`, patches are packed into shard
+        files prefixed by `shard_id`, within `options['phase_path']`.
+    :return: list, the number of patches extracted from each sample.
+    """
+    samples, options, seed, shard_id = args
+    random_state = check_random_state(seed)
+    writer = None
+    extracted = []
+
+    options = dict(options)
+    output = options.get('output', 'files')
+    phase_path = options.pop('phase_path')
+    manifest = ExtractionManifest(phase_path)
+
+    if output == 'shards':
+        writer = PatchShardWriter(phase_path, prefix='shard-%s' % shard_id)
+
+    for sample in samples:
+        name, label, patches_path, n_patches = sample[:4]
+        start = len(writer.rows) if writer else 0
+        try:
+            n = _save_image_patches_coroutine(name=name,
+                                              label=label,
+                                              patches_path=patches_path,
+                                              n_patches=n_patches,
+                                              random_state=random_state,
+                                              writer=writer,
+                                              data=sample[4] if len(sample) > 4 else None,
+                                              **options)
+        except MemoryError:
+            print('failed', name)
+            extracted.append(0)
+            continue
+
+        rows = []
+        if writer is not None:
+            writer.flush()
+            rows = writer.rows[start:]
+
+        manifest.record(os.path.splitext(os.path.basename(name))[0], label,
+                        _extraction_params(options, n_patches), n, rows)
+        extracted.append(n)
+
+    if writer is not None:
+        writer.close()
+    return extracted
 
 
 class DataSet:
@@ -221,6 +678,8 @@ class DataSet:
     SOURCE = None
     COMPACTED_FILE = 'dataset.zip'
     EXPECTED_SIZE = 0
+    EXPECTED_HASH = None
+    HASH_NAME = 'md5'
     EXTRACTED_FOLDER = None
 
     def __init__(self, base_dir='./data', load_mode='exact',
@@ -250,14 +709,32 @@ class DataSet:
 
         self.label_encoder_ = None
         self.feature_names_ = None
+        self.catalog_ = None
 
-        if isinstance(classes, list):
-            self.classes = classes
-        else:
-            self.classes = sorted(os.listdir(os.path.join(self.full_data_path, 'train')))
+        self._requested_classes = classes
+        self.classes = self._list_classes()
 
-            if isinstance(classes, int):
-                self.classes = self.classes[:classes]
+    def _list_classes(self):
+        classes = self._requested_classes
+        train_path = os.path.join(self.full_data_path, 'train')
+
+        if isinstance(classes, list):
+            return classes
+        if not os.path.exists(train_path):
+            # Not extracted (yet): all classes are considered.
+            return None
+
+        labels = sorted(os.listdir(train_path))
+        return labels[:classes] if isinstance(classes, int) else labels
+
+    def _labels(self):
+        """The classes to load, listed once the data set is extracted."""
+        if self.classes is None:
+            self.classes = self._list_classes()
+        if self.classes is None:
+            raise RuntimeError('%s not found. Have you downloaded and extracted '
+                               'the data set first?' % os.path.join(self.full_data_path, 'train'))
+        return self.classes
 
     @property
     def full_data_path(self):
@@ -265,7 +742,16 @@ class DataSet:
         if self.EXTRACTED_FOLDER
         else self.base_dir)
 
-    def download(self, override=False):
+    def download(self, override=False, n_connections=1):
+        """Download the dataset's compacted file.
+
+        Interrupted downloads are resumed. See `connoisseur.utils.download`.
+
+        :param override: bool, download the file again even if it already
+            exists, discarding previous partial downloads.
+        :param n_connections: int, the number of segments of the file
+            downloaded concurrently.
+        """
         os.makedirs(self.base_dir, exist_ok=True)
         file_name = os.path.join(self.base_dir, self.COMPACTED_FILE)
 
@@ -276,9 +762,12 @@ class DataSet:
                 return self
 
             print('copy corrupted. Re-downloading dataset.')
+            os.remove(file_name)
 
         print('downloading', self.SOURCE)
-        file_name, _ = request.urlretrieve(self.SOURCE, file_name)
+        download(self.SOURCE, file_name, n_connections=n_connections,
+                 expected_hash=self.EXPECTED_HASH, hash_name=self.HASH_NAME,
+                 resume=not override)
         stat = os.stat(file_name)
         print('%s downloaded (%i bytes).'
               % (self.COMPACTED_FILE, stat.st_size))
@@ -298,6 +787,7 @@ class DataSet:
             extractor = self._get_specific_extractor(zipped)
             extractor.extractall(self.base_dir)
             extractor.close()
+            self.catalog_ = None
 
             print('dataset extracted.')
         return self
@@ -305,6 +795,54 @@ class DataSet:
     def prepare(self, override=False):
         return self
 
+    def _layout_marker(self, phase):
+        return os.path.join(self.full_data_path, '.%s.layout' % phase)
+
+    def layout(self, phase, source, files, labels, link='hard', override=False):
+        """Organize `files` into `{phase}/{label}` folders, using `n_jobs`
+        threads (one label at a time per thread).
+
+        A marker file is written once done, after which laying out `phase`
+        again does nothing.
+
+        :param source: str, the folder containing `files`.
+        :param files: list of file names.
+        :param labels: list, the label of each file.
+        :param link: str, how files are placed in the label folders:
+            * 'hard': hardlinks to the files in `source`, which must be in
+                the same file system.
+            * 'symbolic': relative symbolic links to the files in `source`.
+            * 'move': the files are moved out of `source`.
+        :param override: bool, lay out the files even if `phase` was already
+            laid out. Files already in place are kept.
+        """
+        if link not in LAYOUT_LINKS:
+            raise ValueError('unknown link %s. Options are: %s' % (link, LAYOUT_LINKS))
+
+        marker = self._layout_marker(phase)
+        if os.path.exists(marker) and not override:
+            print('%s layout skipped.' % phase)
+            return self
+
+        destination = os.path.join(self.full_data_path, phase)
+        groups = pd.Series(np.asarray(files)).groupby(np.asarray(labels).astype(str))
+        tasks = [(source, os.path.join(destination, label), f.tolist(), link)
+                 for label, f in groups]
+
+        print('laying out %i files into %i %s folders (%s)...' % (len(files), len(tasks), phase, link))
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            placed, missing = zip(*executor.map(_layout_label_folder, tasks)) if tasks else ((), ())
+
+        missing = list(itertools.chain(*missing))
+        if missing:
+            print('%i files not found in %s:' % (len(missing), source), missing[:10], '...')
+
+        with open(marker, 'w') as f:
+            json.dump(dict(link=link, files=len(files), placed=sum(placed), missing=len(missing)), f)
+        self.catalog_ = None
+        print('%s layout done.' % phase)
+        return self
+
     @staticmethod
     def _get_specific_extractor(zipped):
         ext = os.path.splitext(zipped)[1]
@@ -322,20 +860,42 @@ class DataSet:
                                    'and extracted it first?')
         return self
 
-    def split(self, fraction, phase='valid'):
+    def split(self, fraction, phase='valid', method='move'):
+        """Split the training paintings, forming `phase`.
+
+        :param fraction: int or float, the number or the fraction of
+            training paintings assigned to `phase`.
+        :param method: str, how paintings are assigned. Options are:
+            * 'move': paintings are moved into the `{phase}` folder.
+            * 'manifest': paintings stay in the `train` folder and are listed
+                in a `SplitManifest` (`split.json`), honored by all loaders.
+                Splitting again replaces `phase`'s previous paintings.
+        """
         base = self.full_data_path
 
+        if method not in ('move', 'manifest'):
+            raise ValueError('unknown split method %s' % method)
+
         if os.path.exists(os.path.join(base, phase)):
             print('train-%s splitting skipped.' % phase)
             return self
 
         print('splitting train-%s data...' % phase)
 
+        split = None
+        if method == 'manifest':
+            split = SplitManifest.load_if_exists(split_file_name(base)) or SplitManifest()
+            split.phases.pop(phase, None)
+
         labels = os.listdir(os.path.join(base, 'train'))
         files = [list(map(lambda x: os.path.join(l, x),
                           os.listdir(os.path.join(base, 'train', l))))
                  for l in labels]
         files = np.array(list(itertools.chain(*files)))
+
+        if split is not None:
+            # Paintings assigned to other phases are not available.
+            files = files[split.mask('train', files)]
         self.random_state.shuffle(files)
 
         faction = (fraction if isinstance(fraction, int) else
@@ -345,16 +905,92 @@ class DataSet:
             faction, files.shape[0], phase))
         train_files, phase_values = files[faction:], files[:faction]
 
+        if split is not None:
+            split.phases[phase] = {painting_of(f) for f in phase_values}
+            split.save(split_file_name(base))
+            print('split saved to', split_file_name(base))
+            return self
+
         for l in labels:
             os.makedirs(os.path.join(base, phase, l), exist_ok=True)
 
         for file in phase_values:
             shutil.move(os.path.join(base, 'train', file),
                         os.path.join(base, phase, file))
+
+        # Only the moved paintings are cataloged again.
+        self.catalog_ = None
+        self._load_catalog()
         print('splitting done.')
         return self
 
-    def load_patches_from_full_images(self, *phases):
+    def build_catalog(self, means=True):
+        """Build (or update) the catalog of the dataset's paintings, using
+        `n_jobs` processes. See `connoisseur.utils.catalog.load_catalog`.
+
+        Once built, the catalog is used to list the paintings of each phase.
+        """
+        self.catalog_ = load_catalog(self.full_data_path, n_jobs=self.n_jobs, means=means)
+        return self
+
+    def _load_catalog(self):
+        """Load the catalog, if it was built.
+
+        It is updated first if paintings were added, removed or moved since
+        it was saved. Only these paintings are cataloged again.
+        """
+        path = self.full_data_path
+
+        if self.catalog_ is None and os.path.exists(catalog_file_name(path)):
+            catalog = load_catalog(path, update=False)
+            if is_outdated(path):
+                catalog = load_catalog(path, n_jobs=self.n_jobs, means=not np.isnan(catalog['r']).all())
+            self.catalog_ = catalog
+        return self.catalog_
+
+    def _load_split(self):
+        return SplitManifest.load_if_exists(split_file_name(self.full_data_path))
+
+    def _phase_samples(self, phase, labels, split=None):
+        """List the paintings of each label in `phase`, honoring the split
+        manifest `split`, if any. Paintings are listed from the dataset's
+        catalog, if it was built.
+
+        :return: (folder, samples), the phase folder in which the paintings
+            are stored and a dict {label: file names}.
+        """
+        folder = phase if split is None or phase not in split else 'train'
+
+        catalog = self._load_catalog()
+
+        if catalog is not None:
+            c = catalog[catalog['phase'] == folder]
+            # The catalog is sorted by path, so each label is contiguous.
+            keys, starts, counts = np.unique(c['label'], return_index=True, return_counts=True)
+            bounds = {k: (i, i + n) for k, i, n in zip(keys, starts, counts)}
+            samples = {label: [p.rpartition('/')[-1] for p in c['path'][slice(*bounds[label])]]
+                       if label in bounds else []
+                       for label in labels}
+        else:
+            samples = {label: os.listdir(os.path.join(self.full_data_path, folder, label))
+                       for label in labels}
+
+        if split is not None and phase in split:
+            mask = iter(split.mask(phase, [label + '/' + x for label in labels for x in samples[label]]))
+            samples = {label: [x for x in samples[label] if next(mask)] for label in labels}
+        return folder, samples
+
+    def load_patches_from_full_images(self, *phases, dtype=np.float32, temp_dir=None):
+        """Load random patches from the full images.
+
+        Patches are written by the workers directly into a shared uint8
+        array, shaped as (samples, n_patches, height, width, 3).
+
+        :param dtype: the type to which the patches are converted. If
+            `np.uint8`, the shared array is returned without any copy.
+        :param temp_dir: str, where the shared array is created. See
+            `_shared_array`.
+        """
         phases = phases or ('train', 'valid', 'test')
         print('loading %s images' % ','.join(phases))
 
@@ -363,11 +999,11 @@ class DataSet:
         # Keras (height, width) -> PIL Image (width, height)
         patch_size = self.image_shape
         patch_size = [patch_size[1], patch_size[0]]
-        labels = self.classes
+        labels = self._labels()
+        split = self._load_split()
 
-        n_samples_per_label = np.array(
-            [len(os.listdir(os.path.join(data_path, 'train', label)))
-             for label in labels])
+        _, train_samples = self._phase_samples('train', labels, split)
+        n_samples_per_label = np.array([len(train_samples[label]) for label in labels])
         rates = n_samples_per_label / n_samples_per_label.sum()
 
         if 'train' in phases:
@@ -385,27 +1021,38 @@ class DataSet:
             n_patches = getattr(self, '%s_n_patches' % phase)
             augmentations = getattr(self, '%s_augmentations' % phase)
 
-            X, y, names = [], [], []
+            samples, y, names = [], [], []
+            folder, phase_samples = self._phase_samples(phase, labels, split)
 
             for label in labels:
-                class_path = os.path.join(data_path, phase, label)
-
-                samples = os.listdir(class_path)
+                label_samples = phase_samples[label]
+                class_path = os.path.join(data_path, folder, label)
 
                 if phase == 'train' and self.load_mode == 'balanced':
-                    self.random_state.shuffle(samples)
-                    samples = samples[:min_n_samples]
-
+                    self.random_state.shuffle(label_samples)
+                    label_samples = label_samples[:min_n_samples]
+
+                samples += [(os.path.join(class_path, n), r)
+                            for r, n in enumerate(label_samples)]
+                y += len(label_samples) * [label]
+                names += label_samples
+
+            output = _shared_array((len(samples), n_patches,
+                                    patch_size[1], patch_size[0], 3),
+                                   np.uint8, temp_dir)
+            try:
                 with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
-                    patches_per_sample = list(executor.map(
+                    list(executor.map(
                         _load_patches_coroutine,
-                        [(os.path.join(class_path, n), patch_size, n_patches,
-                          augmentations, r)
-                         for r, n in enumerate(samples)]))
+                        [(n, patch_size, n_patches, augmentations, r, output, i)
+                         for i, (n, r) in enumerate(samples)]))
 
-                X += patches_per_sample
-                y += len(samples) * [label]
-                names += samples
+                X = np.load(output, mmap_mode='r+')
+                if np.dtype(dtype) != np.uint8:
+                    X = X.astype(dtype)
+            finally:
+                # The mapping outlives the file, which is released along with it.
+                os.remove(output)
 
             if phase == 'train':
                 self.label_encoder_ = LabelEncoder().fit(y)
@@ -415,71 +1062,302 @@ class DataSet:
                                  'to initialize the label encoder that will '
                                  'be used to transform the %s data.' % phase)
             y = self.label_encoder_.transform(y)
-            results.append([np.array(X, copy=False), y,
-                            np.array(names, copy=False)])
+            results.append([X, y, np.array(names, copy=False)])
         print('loading completed.')
         return results
 
     def load_patches(self, *phases):
+        """Load the patches previously extracted to
+        `{full_data_path}/extracted_patches`.
+
+        Patches of all phases are decoded by a single pool of `n_jobs`
+        threads, to which all patches of a phase are submitted at once.
+        """
         phases = phases or ('train', 'valid', 'test')
 
         results = []
         data_path = self.full_data_path
-        labels = self.classes
+        labels = self._labels()
         r = self.random_state
+        split = self._load_split()
+
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            for phase in phases:
+                n_patches = getattr(self, '%s_n_patches' % phase)
+                enhancer = getattr(self, '%s_enhancer' % phase)
+
+                tasks, sample_n_patches, y, names = [], [], [], []
+                folder, phase_samples = self._phase_samples(phase, labels, split)
+
+                for label in labels:
+                    label_samples = phase_samples[label]
+                    label_patch_path = os.path.join(data_path,
+                                                    'extracted_patches',
+                                                    folder, label)
+                    samples_names = [os.path.splitext(p)[0]
+                                     for p in label_samples]
+                    patches_index = index_patches(os.listdir(label_patch_path))
+
+                    for sample in samples_names:
+                        sample_patches_names = list(patches_index.get(sample, ()))
+                        if (n_patches is not None and
+                            len(sample_patches_names) < n_patches):
+                            sample_patches_names = r.choice(sample_patches_names,
+                                                            n_patches)
+                        else:
+                            r.shuffle(sample_patches_names)
+
+                        sample_patches_names = sample_patches_names[:n_patches]
+
+                        tasks += [dict(name=os.path.join(label_patch_path, sample_patch_name),
+                                       augmentations=enhancer.augmentations,
+                                       variability=enhancer.variability)
+                                  for sample_patch_name in sample_patches_names]
+                        sample_n_patches.append(len(sample_patches_names))
+                        y.append(label)
+                        names.append(sample)
+
+                # Patches are streamed back in the order they were submitted.
+                patches = executor.map(_load_patch_coroutine, tasks)
+                X = [list(itertools.islice(patches, n)) for n in sample_n_patches]
+
+                if phase == 'train':
+                    self.label_encoder_ = LabelEncoder().fit(y)
+
+                if self.label_encoder_ is None:
+                    raise ValueError('you need to load train data first in order '
+                                     'to initialize the label encoder that will '
+                                     'be used to transform the %s data.' % phase)
+                y = self.label_encoder_.transform(y)
+                results.append([np.array(X, copy=False), y,
+                                np.array(names, copy=False)])
+        return results
+
+    def _archive_member_name(self, *path):
+        return '/'.join(((self.EXTRACTED_FOLDER,) if self.EXTRACTED_FOLDER else ()) + path)
+
+    def _archive_phase_members(self, archive_names, phase):
+        """The samples of each label of `phase` in the dataset's archive,
+        stored as `[{EXTRACTED_FOLDER}/]{phase}/{label}/{sample}`.
+
+        :return: dict {label: [samples]}.
+        """
+        prefix = self._archive_member_name(phase) + '/'
+        members = defaultdict(list)
+
+        for n in archive_names:
+            if n.startswith(prefix):
+                label, _, sample = n[len(prefix):].partition('/')
+                if sample and '/' not in sample:
+                    members[label].append(sample)
+        return members
+
+    def _save_phases_patches(self, directory, phases, options):
+        data_path = self.full_data_path
+        mode = options['mode']
+        archive_names = None
+        plans = []
+
+        if options.get('archive'):
+            archive_names = _archive_names(options['archive'])
 
         for phase in phases:
             n_patches = getattr(self, '%s_n_patches' % phase)
-            enhancer = getattr(self, '%s_enhancer' % phase)
 
-            X, y, names = [], [], []
+            print('extracting %s patches to disk...' % phase)
 
-            for label in labels:
-                label_sample_path = os.path.join(data_path, phase, label)
-                label_patch_path = os.path.join(data_path,
-                                                'extracted_patches',
-                                                phase, label)
-                samples_names = [os.path.splitext(p)[0]
-                                 for p in os.listdir(label_sample_path)]
-                patches_names = os.listdir(label_patch_path)
-
-                for sample in samples_names:
-                    sample_patches_names = list(filter(lambda x: sample in x,
-                                                       patches_names))
-                    if (n_patches is not None and
-                        len(sample_patches_names) < n_patches):
-                        sample_patches_names = r.choice(sample_patches_names,
-                                                        n_patches)
-                    else:
-                        r.shuffle(sample_patches_names)
-
-                    sample_patches_names = sample_patches_names[:n_patches]
-
-                    with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
-                        _patches = list(executor.map(
-                            _load_patch_coroutine,
-                            [dict(name=os.path.join(label_patch_path, sample_patch_name),
-                                  augmentations=enhancer.augmentations,
-                                  variability=enhancer.variability)
-                             for sample_patch_name in sample_patches_names]))
-
-                    X.append(_patches)
-                    y.append(label)
-                    names.append(sample)
+            sharded = options.get('output') == 'shards'
+            phase_path = os.path.join(directory, phase)
 
-            if phase == 'train':
-                self.label_encoder_ = LabelEncoder().fit(y)
+            if archive_names is not None and not self._archive_phase_members(archive_names, phase):
+                print('  %s not found in the archive' % phase)
+                continue
 
-            if self.label_encoder_ is None:
-                raise ValueError('you need to load train data first in order '
-                                 'to initialize the label encoder that will '
-                                 'be used to transform the %s data.' % phase)
-            y = self.label_encoder_.transform(y)
-            results.append([np.array(X, copy=False), y,
-                            np.array(names, copy=False)])
-        return results
+            os.makedirs(phase_path, exist_ok=True)
+
+            if not sharded and is_sharded(phase_path):
+                # Patches are now written as files. Paintings extracted into
+                # shards are extracted again, as their params differ.
+                os.remove(os.path.join(phase_path, INDEX_FILE))
+            phase_options = dict(options, phase_path=phase_path)
+            manifest = ExtractionManifest(phase_path)
+            completed = manifest.load()
+
+            if archive_names is None:
+                labels = self.classes or os.listdir(os.path.join(data_path, phase))
+                label_paths = [os.path.join(data_path, phase, label) for label in labels]
+                label_samples = [os.listdir(p) for p in label_paths]
+            else:
+                members = self._archive_phase_members(archive_names, phase)
+                labels = self.classes or sorted(members)
+                label_paths = [self._archive_member_name(phase, label) for label in labels]
+                label_samples = [members.get(label, []) for label in labels]
+
+            if mode == 'balanced':
+                label_weights = np.asarray([len(s) for s in label_samples], 'float')
+                label_weights = 1.0 / np.maximum(label_weights, 1)
+                label_weights /= label_weights.max()
+            else:
+                label_weights = np.ones(len(label_samples))
+
+            print('weights:', label_weights.tolist())
+
+            tasks, task_labels, phase_paintings = [], [], []
+
+            for label, input_dir, samples, weight in zip(labels, label_paths, label_samples, label_weights):
+                output_dir = os.path.join(phase_path, label)
+                existing = {}
+
+                if not sharded:
+                    os.makedirs(output_dir, exist_ok=True)
+                if os.path.isdir(output_dir):
+                    # Also removes the files of extractions made before
+                    # switching to shards.
+                    existing = index_patches(os.listdir(output_dir))
+
+                _n_patches = ceil(n_patches * weight)
+                params = _extraction_params(options, _n_patches)
+                n_completed = 0
+
+                for sample in samples:
+                    painting = os.path.splitext(sample)[0]
+                    phase_paintings.append((label, painting))
+                    entry = completed.get((label, painting))
+
+                    if entry is not None and entry['params'] == params:
+                        n_completed += 1
+                        continue
+
+                    # Patches of interrupted or outdated extractions are replaced.
+                    for patch_name in existing.get(painting, ()):
+                        os.remove(os.path.join(output_dir, patch_name))
+
+                    tasks.append((input_dir + '/' + sample if archive_names else os.path.join(input_dir, sample),
+                                  label, output_dir, _n_patches))
+                    task_labels.append(label)
 
-    def save_patches_to_disk(self, directory, mode='all', low_threshold=.9, pool_size=2):
+                if n_completed:
+                    print('  %i/%i samples of %s already extracted' % (n_completed, len(samples), label))
+
+            if archive_names is not None:
+                # Members are processed in the order they are stored.
+                position = {n: i for i, n in enumerate(archive_names)}
+                order = sorted(range(len(tasks)), key=lambda i: position[tasks[i][0]])
+                tasks = [tasks[i] for i in order]
+                task_labels = [task_labels[i] for i in order]
+
+            plans.append(dict(phase=phase, phase_path=phase_path, options=phase_options, manifest=manifest,
+                              labels=labels, tasks=tasks, task_labels=task_labels,
+                              phase_paintings=phase_paintings))
+
+        # New shards never overwrite the ones of previous runs.
+        run = uuid.uuid4().hex[:8]
+
+        if archive_names is not None and not _is_zip(options['archive']):
+            # All phases are extracted in a single pass over the archive.
+            extracted = self._save_streamed_patches(options['archive'], plans, run)
+        else:
+            extracted = [self._save_tasks_patches(p['tasks'], p['options'], run) for p in plans]
+        _close_archives()
+
+        for plan, plan_extracted in zip(plans, extracted):
+            if options.get('output') == 'shards':
+                # The index is saved last, marking the phase as completed.
+                completed = plan['manifest'].load()
+                save_index(plan['phase_path'], [tuple(r)
+                                                for k in plan['phase_paintings'] if k in completed
+                                                for r in completed[k]['rows']])
+
+            plan_extracted = np.asarray(plan_extracted, dtype=int)
+            task_labels = np.asarray(plan['task_labels'])
+
+            for label in plan['labels']:
+                s = task_labels == label
+                if s.any():
+                    print('%i %s patches extracted from %i samples of %s'
+                          % (plan_extracted[s].sum(), plan['phase'], s.sum(), label))
+
+    def _save_tasks_patches(self, tasks, options, run):
+        """Extract the patches of `tasks`, using `n_jobs` processes.
+
+        :return: array, the number of patches extracted from each task.
+        """
+        if self.n_jobs == 1:
+            return _save_patches_shard_coroutine((tasks, options, self.random_state, '%s-0' % run))
+
+        # Samples are interleaved across shards, balancing the labels
+        # each worker processes. Each shard has its own random state,
+        # seeded from the data set's.
+        seeds = self.random_state.randint(np.iinfo(np.int32).max, size=self.n_jobs)
+        with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+            shards = list(executor.map(
+                _save_patches_shard_coroutine,
+                [(tasks[i::self.n_jobs], options, seed, '%s-%i' % (run, i))
+                 for i, seed in enumerate(seeds)]))
+
+        extracted = np.empty(len(tasks), dtype=int)
+        for i, shard_extracted in enumerate(shards):
+            extracted[i::self.n_jobs] = shard_extracted
+        return extracted
+
+    def _save_streamed_patches(self, archive_name, plans, run, chunk_size=32):
+        """Extract the patches of the tasks of all `plans` from a tar archive.
+
+        Tar archives cannot be read at random without being decompressed
+        from their start. Instead, the archive is streamed (decompressed)
+        once by this process, which hands the members of every phase's
+        tasks to the workers in chunks of `chunk_size` paintings of a same
+        phase. At most `2 * n_jobs` chunks are held in memory.
+
+        :return: list of arrays, the number of patches extracted from each
+            task of each plan.
+        """
+        position = {t[0]: (p, i) for p, plan in enumerate(plans) for i, t in enumerate(plan['tasks'])}
+        extracted = [np.zeros(len(plan['tasks']), dtype=int) for plan in plans]
+        executor = ProcessPoolExecutor(max_workers=self.n_jobs) if self.n_jobs > 1 else None
+        pending = {}
+        chunks = [[] for _ in plans]
+
+        def collect(futures):
+            for f in futures:
+                p, indices = pending.pop(f)
+                extracted[p][indices] = f.result()
+
+        def submit(p):
+            chunk = chunks[p]
+            indices = [position[t[0]][1] for t in chunk]
+            args = (list(chunk), plans[p]['options'], self.random_state.randint(np.iinfo(np.int32).max),
+                    '%s-%i' % (run, indices[0]))
+            chunk.clear()
+
+            if executor is None:
+                extracted[p][indices] = _save_patches_shard_coroutine(args)
+                return
+            if len(pending) >= 2 * self.n_jobs:
+                collect(wait(pending, return_when=FIRST_COMPLETED).done)
+            pending[executor.submit(_save_patches_shard_coroutine, args)] = p, indices
+
+        try:
+            with tarfile.open(archive_name, 'r|*') as archive:
+                for member in archive:
+                    if member.name not in position:
+                        continue
+                    p, i = position[member.name]
+                    chunks[p].append(plans[p]['tasks'][i] + (archive.extractfile(member).read(),))
+                    if len(chunks[p]) == chunk_size:
+                        submit(p)
+            for p, chunk in enumerate(chunks):
+                if chunk:
+                    submit(p)
+            collect(list(pending))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return extracted
+
+    def save_patches_to_disk(self, directory, mode='all', low_threshold=.9, pool_size=1,
+                             backend='numpy', output='files', max_pixels=2 ** 25,
+                             from_archive=False):
         """Extract and save patches to disk.
 
         :param directory: str, directory in which the patches will be saved.
@@ -501,6 +1379,35 @@ class DataSet:
             will decrease the accuracy of the procedure but decrease in time
             and memory requirements.
             Ignored if mode != 'max-gradient'.
+        :param backend: str, how the gradient modes score the patches:
+            * 'numpy': sum the edges in each patch using a summed-area table,
+                in constant time per patch. Use `pool_size=1` to score the
+                patches at full resolution.
+            * 'tensorflow': convolve the edges with a kernel of ones.
+            Samples are processed by `n_jobs` worker processes when
+            `n_jobs > 1`, which always use the 'numpy' backend.
+        :param output: str, how patches are written. Options are:
+            * 'files': each patch is saved as `{phase}/{label}/{painting}-{id}.jpg`.
+            * 'shards': patches are packed into large shard files within
+                `{phase}/`, which can be read with
+                `connoisseur.utils.shards.PatchShards`.
+        :param max_pixels: int, memory ceiling of the gradient modes. Edges
+            of images with more pixels than this are detected and scored in
+            overlapping tiles of at most `max_pixels` pixels, using the
+            'numpy' backend. Canny uses a few tens of bytes per pixel.
+            If None, images are always scored at once.
+        :param from_archive: bool, read the paintings directly from the
+            dataset's compacted file, which does not need to be extracted.
+            Its members must be organized as
+            `[{EXTRACTED_FOLDER}/]{phase}/{label}/{painting}`. Zip members
+            are read by the workers themselves. Tar files can only be read
+            sequentially: they are streamed (decompressed) twice by this
+            process, once to be listed and once to extract all phases,
+            handing the paintings to the workers.
+
+        Phases of a split manifest (see `split`) are not extracted, as their
+        paintings are in the `train` folder, which is extracted as a whole.
+        Loaders and sequences select each phase's patches from it.
 
         :return: self
         """
@@ -513,12 +1420,26 @@ class DataSet:
 
         os.makedirs(directory, exist_ok=True)
 
-        phases = list(filter(lambda _p: os.path.exists(os.path.join(data_path, _p)),
-                             ('train', 'test', 'valid')))
+        archive = None
+
+        if from_archive:
+            # Phases missing from the archive are skipped later.
+            archive = os.path.join(self.base_dir, self.COMPACTED_FILE)
+            phases = ['train', 'test', 'valid']
+        else:
+            phases = list(filter(lambda _p: os.path.exists(os.path.join(data_path, _p)),
+                                 ('train', 'test', 'valid')))
+
+        if backend not in ('numpy', 'tensorflow'):
+            raise ValueError('unknown backend %s' % backend)
+        if output not in ('files', 'shards'):
+            raise ValueError('unknown output %s' % output)
 
         tensors = None
 
-        if mode in ('min-gradient', 'max-gradient'):
+        if mode in ('min-gradient', 'max-gradient') and backend == 'tensorflow' and self.n_jobs == 1:
+            import tensorflow as tf
+
             with tf.name_scope('max_gradient_patches'):
                 x = tf.placeholder(tf.float32, shape=(1, None, None, 1))
 
@@ -532,59 +1453,23 @@ class DataSet:
 
             tensors = (x, y)
 
-        tf_config = tf.ConfigProto(allow_soft_placement=True)
-        tf_config.gpu_options.allow_growth = True
-        with tf.Session(config=tf_config):
-            tf.global_variables_initializer().run()
-
-            for phase in phases:
-                n_patches = getattr(self, '%s_n_patches' % phase)
-
-                print('extracting %s patches to disk...' % phase)
-
-                labels = self.classes or os.listdir(os.path.join(data_path, phase))
-                label_paths = [os.path.join(data_path, phase, label) for label in labels]
-                label_samples = [os.listdir(p) for p in label_paths]
-
-                if mode == 'balanced':
-                    label_weights = np.asarray([len(s) for s in label_samples], 'float')
-                    label_weights = 1.0 / np.maximum(label_weights, 1)
-                    label_weights /= label_weights.max()
-                else:
-                    label_weights = np.ones(len(label_samples))
-
-                print('weights:', label_weights.tolist())
-
-                for label, input_dir, samples, weight in zip(labels, label_paths, label_samples, label_weights):
-                    output_dir = os.path.join(directory, phase, label)
-                    all_patches = 0
-
-                    _n_patches = ceil(n_patches * weight)
-
-                    if os.path.exists(output_dir):
-                        print('  skipped', label)
-                        continue
-
-                    os.makedirs(output_dir, exist_ok=True)
-
-                    for sample in samples:
-                        try:
-                            _save_image_patches_coroutine(
-                                name=os.path.join(input_dir, sample),
-                                patches_path=output_dir,
-                                patch_size=patch_size,
-                                n_patches=_n_patches,
-                                mode=mode,
-                                low_threshold=low_threshold,
-                                pool_size=pool_size,
-                                tensors=tensors)
-
-                            all_patches += _n_patches
-                        except MemoryError:
-                            print('failed')
-
-                    print('%i patches extracted from %i samples of %s'
-                          % (all_patches, len(samples), label))
+        options = dict(patch_size=patch_size,
+                       mode=mode,
+                       low_threshold=low_threshold,
+                       pool_size=pool_size,
+                       output=output,
+                       backend='numpy' if tensors is None else 'tensorflow',
+                       max_pixels=max_pixels,
+                       archive=archive)
+
+        if tensors is None:
+            self._save_phases_patches(directory, phases, options)
+        else:
+            tf_config = tf.ConfigProto(allow_soft_placement=True)
+            tf_config.gpu_options.allow_growth = True
+            with tf.Session(config=tf_config):
+                tf.global_variables_initializer().run()
+                self._save_phases_patches(directory, phases, dict(options, tensors=tensors))
 
         print('patches extraction completed.')
 
@@ -4,57 +4,130 @@ Author: Lucas David -- <lucasolivdavid@gmail.com>
 Licence: MIT License 2016 (c)
 
 """
+import hashlib
 import os
-import re
-import shutil
+import pickle
 
 import numpy as np
 import pandas as pd
 from sklearn.pipeline import make_pipeline
-from sklearn.preprocessing import LabelEncoder, Imputer, OneHotEncoder, StandardScaler
+from sklearn.preprocessing import LabelEncoder, Imputer, StandardScaler
 
 from .base import DataSet
 
 
-def load_multiple_outputs(train_info, outputs_meta, encode='onehot'):
-    assert encode in ('onehot', 'sparse'), 'unknown encode %s' % encode
+YEAR_PATTERN = r'^(?:\w*[\s\.])?(\d{3,4})(?:\.0?)?$'
 
-    def to_year(e):
-        year_pattern = r'(?:\w*[\s\.])?(\d{3,4})(?:\.0?)?$'
-        try:
-            return e if isinstance(e, float) else float(re.match(year_pattern, e).group(1))
-        except (AttributeError, ValueError):
-            print('unknown year', e)
-            return np.nan
 
-    y_train = pd.read_csv(train_info, quotechar='"', delimiter=',')
+class OneHotCodes:
+    """One-Hot Codes.
 
-    categorical_output_names = ['artist', 'style', 'genre']
-    outputs = {}
+    Integer labels, one-hot encoded only when indexed (e.g. per batch),
+    instead of kept as a dense (n_samples, n_classes) matrix.
 
-    for meta in outputs_meta:
-        n = meta['n']
-        if n in categorical_output_names:
-            en = LabelEncoder()
-            is_nan = pd.isnull(y_train[n])
-            encoded = en.fit_transform(y_train[n].apply(str).str.lower()).astype('float')
-            encoded[is_nan] = np.nan
+    Parameters
+    ----------
+    codes: array-like, shaped as (n_samples,) or (n_samples, 1), the labels.
+    n_classes: int, the number of columns of the one-hot encoding.
+    """
 
-            flow = make_pipeline(Imputer(strategy='most_frequent'),
-                                 OneHotEncoder(sparse=False) if encode == 'onehot' else None)
-            encoded = flow.fit_transform(encoded.reshape(-1, 1))
+    def __init__(self, codes, n_classes):
+        self.codes = np.asarray(codes).ravel()
+        self.n_classes = n_classes
+
+    @property
+    def shape(self):
+        return len(self.codes), self.n_classes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, item):
+        codes = self.codes[item]
+        return (codes[..., np.newaxis] == np.arange(self.n_classes)).astype(np.float32)
+
+
+def _parse_years(dates):
+    """Parse years out of the `date` column, such as "c.1890" or "1890.0"."""
+    if dates.dtype.kind == 'f':
+        return dates.values
+
+    years = dates.astype(str).str.extract(YEAR_PATTERN, expand=False).astype(float)
+    unknown = dates.notnull() & years.isnull()
+    if unknown.any():
+        print('unknown years:', dates[unknown].unique().tolist())
+    return years.values
+
+
+def _encode_outputs(y_train, names):
+    outputs, flows = {}, {}
+
+    for n in names:
+        if n in ('artist', 'style', 'genre'):
+            is_nan = y_train[n].isnull().values
+            en = LabelEncoder()
+            codes = np.empty(len(y_train), dtype=np.int32)
+            codes[~is_nan] = en.fit_transform(y_train[n][~is_nan].apply(str).str.lower())
+            # Missing labels are imputed with the most frequent one.
+            codes[is_nan] = np.bincount(codes[~is_nan]).argmax()
+            encoded, flow = codes.reshape(-1, 1), en
         else:
-            encoded = y_train[n] if n != 'date' else y_train['date'].apply(to_year)
-            encoded = encoded.values
+            encoded = y_train[n].values if n != 'date' else _parse_years(y_train['date'])
             flow = make_pipeline(Imputer(strategy='mean'),
                                  StandardScaler())
 
             encoded = flow.fit_transform(encoded.reshape(-1, 1))
 
         outputs[n] = encoded
-        meta['f'] = flow
+        flows[n] = flow
 
     name_map = {os.path.splitext(n)[0]: i for i, n in enumerate(y_train['filename'])}
+    return outputs, flows, name_map
+
+
+def load_multiple_outputs(train_info, outputs_meta, encode='onehot', cache=True):
+    """Load the outputs (artist, style, genre, date) of the paintings.
+
+    Categorical outputs are encoded as integer codes, which index the
+    sorted labels (lower-cased), and dates are standardized.
+
+    :param train_info: str, the path to the `train_info.csv` file.
+    :param outputs_meta: list of dicts, the outputs to load, named by their
+        key `n`. The fitted encoder of each output is set into its key `f`.
+    :param encode: str, the encoding of the categorical outputs. Options are:
+        * 'onehot': `OneHotCodes`, expanded when indexed.
+        * 'sparse': the integer codes, shaped as (n_samples, 1).
+    :param cache: bool, whether to reuse the outputs encoded previously.
+        They are cached next to `train_info`, under the hash of its content
+        and the names of the outputs.
+    :return: (outputs, name_map), the outputs by name and the row of each
+        painting (by name, without extension) in the outputs.
+    """
+    assert encode in ('onehot', 'sparse'), 'unknown encode %s' % encode
+
+    names = [meta['n'] for meta in outputs_meta]
+
+    with open(train_info, 'rb') as f:
+        key = hashlib.sha1(f.read() + repr(sorted(names)).encode()).hexdigest()
+    cache_file = os.path.join(os.path.dirname(train_info), '.outputs-%s.pickle' % key[:16])
+
+    if cache and os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            outputs, flows, name_map = pickle.load(f)
+    else:
+        y_train = pd.read_csv(train_info, quotechar='"', delimiter=',')
+        outputs, flows, name_map = _encode_outputs(y_train, names)
+
+        if cache:
+            with open(cache_file, 'wb') as f:
+                pickle.dump((outputs, flows, name_map), f, pickle.HIGHEST_PROTOCOL)
+
+    for meta in outputs_meta:
+        meta['f'] = flows[meta['n']]
+
+        if encode == 'onehot' and isinstance(flows[meta['n']], LabelEncoder):
+            outputs[meta['n']] = OneHotCodes(outputs[meta['n']], len(flows[meta['n']].classes_))
+
     return outputs, name_map
 
 
@@ -68,21 +141,16 @@ class PainterByNumbers(DataSet):
 
         frame = pd.read_csv(fn, quotechar='"', delimiter=',')
         self.feature_names_ = frame.columns.values
-        data = frame.values
-
-        for sample in data:
-            fn, label = sample[:2]
-            os.makedirs(os.path.join(base_dir, 'train', label), exist_ok=True)
-            try:
-                shutil.move(os.path.join(base_dir, 'train', fn),
-                            os.path.join(base_dir, 'train', label, fn))
-            except FileNotFoundError:
-                # Already moved. Ignore.
-                pass
-
-        os.makedirs(os.path.join(base_dir, 'test', 'unknown'), exist_ok=True)
-        for sample in os.listdir(os.path.join(base_dir, 'test')):
-            if os.path.isfile(os.path.join(base_dir, 'test', sample)):
-                shutil.move(os.path.join(base_dir, 'test', sample),
-                            os.path.join(base_dir, 'test', 'unknown', sample))
+
+        # Paintings are extracted right into the `train` and `test` folders,
+        # where links would be mistaken for labels. They are moved instead.
+        self.layout('train', os.path.join(base_dir, 'train'),
+                    frame.iloc[:, 0].values, frame.iloc[:, 1].values,
+                    link='move', override=override)
+
+        if override or not os.path.exists(self._layout_marker('test')):
+            test_dir = os.path.join(base_dir, 'test')
+            samples = [s for s in os.listdir(test_dir) if os.path.isfile(os.path.join(test_dir, s))]
+            self.layout('test', test_dir, samples, ['unknown'] * len(samples),
+                        link='move', override=override)
         return self
@@ -2,6 +2,7 @@ import numpy as np
 from sklearn.base import ClassifierMixin
 
 from . import strategies
+from ..utils.ragged import RaggedArray
 
 
 class Fusion(ClassifierMixin):
@@ -27,12 +28,17 @@ class Fusion(ClassifierMixin):
         :param probabilities: array-like, shaped as (paintings, patches, labels).
         :param hyperplane_distance: array-like, shaped as (paintings, patches, 1).
         :param labels: array-like, shaped as (paintings, patches).
+            `RaggedArray`s are also accepted for paintings with different
+            numbers of patches.
         :return: y, predicted labels, according to a fusion strategy.
         """
         assert probabilities is not None or labels is not None and hyperplane_distance is not None
 
         if labels is None:
-            labels = np.argmax(probabilities, axis=-1)
+            if isinstance(probabilities, RaggedArray):
+                labels = probabilities.map(lambda p: np.argmax(p, axis=-1))
+            else:
+                labels = np.argmax(probabilities, axis=-1)
 
         if probabilities is None:
             # The same operations are applied to these two measures. We can
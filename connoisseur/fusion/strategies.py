@@ -1,11 +1,17 @@
 import numpy as np
 
+from ..utils.ragged import RaggedArray
+
 AVAILABLE_STRATEGIES = ['sum', 'mean', 'farthest', 'most_frequent',
                         'contrastive_mean']
 __all__ = AVAILABLE_STRATEGIES
 
 
 def sum(labels, distances, multi_class=True, t=0.0):
+    if isinstance(distances, RaggedArray):
+        d = distances.sum()
+        return np.argmax(d, axis=-1) if multi_class else (d > t).astype(int)
+
     if multi_class:
         return np.asarray([np.argmax(d.sum(axis=-2), axis=-1) for d in distances])
 
@@ -13,6 +19,10 @@ def sum(labels, distances, multi_class=True, t=0.0):
 
 
 def mean(labels, distances, multi_class=True, t=0.0):
+    if isinstance(distances, RaggedArray):
+        d = distances.mean()
+        return np.argmax(d, axis=-1) if multi_class else (d > t).astype(int)
+
     if multi_class:
         return np.asarray([np.argmax(d.mean(axis=-2), axis=-1) for d in distances])
 
@@ -20,10 +30,20 @@ def mean(labels, distances, multi_class=True, t=0.0):
 
 
 def contrastive_mean(labels, distances, multi_class=True, t=0.0):
+    if isinstance(distances, RaggedArray):
+        return (distances.mean() <= t).astype(np.int)
+
     return (distances.mean(axis=-1) <= t).astype(np.int)
 
 
 def farthest(labels, distances, multi_class=True, t=0.0):
+    if isinstance(distances, RaggedArray):
+        if multi_class:
+            return np.argmax(distances.max(), axis=-1)
+
+        highest, lowest = distances.max(), distances.min()
+        return (np.where(np.abs(highest) >= np.abs(lowest), highest, lowest) > t).astype(int)
+
     if multi_class:
         return np.asarray([np.argmax(d.max(axis=-2), axis=-1) for d in distances])
 
@@ -31,6 +51,13 @@ def farthest(labels, distances, multi_class=True, t=0.0):
 
 
 def most_frequent(labels, distances, multi_class=True, t=0.0):
+    if isinstance(labels, RaggedArray):
+        # Count the occurrences of each label in each row at once.
+        n_labels = labels.data.max() + 1
+        counts = np.bincount(labels.row_ids() * n_labels + labels.data,
+                             minlength=len(labels) * n_labels)
+        return np.argmax(counts.reshape(len(labels), n_labels), axis=-1)
+
     try:
         return np.asarray([np.argmax(np.bincount(patch_labels)) for patch_labels in labels])
     except:
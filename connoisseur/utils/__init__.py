@@ -1,6 +1,7 @@
 from keras import backend as K
 
-from . import image
+from . import image, ragged
+from .ragged import RaggedArray
 
 
 def l2(inputs):
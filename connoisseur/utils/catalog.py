@@ -0,0 +1,136 @@
+"""Dataset Catalogs.
+
+Metadata of the images in a dataset, gathered once and stored in a
+structured `.npy` file, so tools do not need to list and decode the
+images every time.
+
+Author: Lucas David -- <lucasolivdavid@gmail.com>
+Licence: MIT License 2016 (c)
+
+"""
+
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from .probe import list_images, probe_image
+from .records import structured_array
+
+CATALOG_FILE = 'catalog.npy'
+
+_FIELDS = [('width', np.int32), ('height', np.int32), ('size', np.int64), ('mtime', np.int64),
+           ('hash', 'U40'), ('r', np.float32), ('g', np.float32), ('b', np.float32)]
+
+
+def catalog_file_name(directory):
+    return os.path.join(directory, CATALOG_FILE)
+
+
+def is_outdated(directory, file_name=None):
+    """Check whether images may have been added, removed or moved in
+    `directory` since its catalog was last saved or updated.
+
+    Only the modification times of `directory` and of the folders listed
+    by `list_images` are compared to the catalog's, so no image is read.
+    """
+    file_name = file_name or catalog_file_name(directory)
+    if not os.path.exists(file_name):
+        return True
+
+    saved = os.stat(file_name).st_mtime_ns
+    for root, dirs, _ in os.walk(directory):
+        # Changes within the same clock tick as the catalog are not missed.
+        if os.stat(root).st_mtime_ns >= saved:
+            return True
+        depth = 0 if root == directory else os.path.relpath(root, directory).count(os.sep) + 1
+        dirs[:] = [] if depth == 2 else [d for d in dirs if not d.startswith('.')]
+    return False
+
+
+def _describe_image(args):
+    """Read the metadata of an image.
+
+    The size comes from the header. Means are computed over the image
+    decoded at the smallest scale its format allows (1/8 for JPEGs, whose
+    blocks are then averaged by the decoder itself).
+    """
+    file_name, means = args
+    stat = os.stat(file_name)
+
+    h = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 ** 2), b''):
+            h.update(chunk)
+
+    if means:
+        with Image.open(file_name) as image:
+            width, height = image.size
+            image.draft('RGB', (max(1, width // 8), max(1, height // 8)))
+            rgb = tuple(np.asarray(image.convert('RGB'), dtype=np.float64).mean(axis=(0, 1)))
+    else:
+        width, height = probe_image(file_name)[:2]
+        rgb = (np.nan,) * 3
+
+    return (width, height, stat.st_size, stat.st_mtime_ns, h.hexdigest()) + rgb
+
+
+def load_catalog(directory, n_jobs=1, means=True, update=True, file_name=None):
+    """Load the catalog of the images in `directory`, building it if needed.
+
+    :param n_jobs: int, the number of processes reading new images.
+    :param means: bool, whether to compute the mean of each RGB channel,
+        which requires decoding the images (at a reduced scale).
+    :param update: bool, whether to look for new, modified and removed
+        images. Only images whose size or modification time changed are
+        read again. If False, an existing catalog is returned as is, even
+        if outdated (see `is_outdated`).
+    :param file_name: str, where the catalog is stored. Defaults to
+        `{directory}/catalog.npy`.
+    :return: structured array with the fields `path`, `phase`, `label`,
+        `width`, `height`, `size`, `mtime`, `hash`, `r`, `g` and `b`,
+        sorted by `path`.
+    """
+    file_name = file_name or catalog_file_name(directory)
+    catalog = np.load(file_name) if os.path.exists(file_name) else None
+
+    if catalog is not None and not update:
+        return catalog
+
+    images = list_images(directory)
+    previous = {} if catalog is None else {r['path']: r for r in catalog}
+    rows, pending = [], []
+
+    for path, phase, label in images:
+        stat = os.stat(os.path.join(directory, path))
+        r = previous.get(path)
+
+        if (r is not None and r['size'] == stat.st_size and r['mtime'] == stat.st_mtime_ns and
+                not (means and np.isnan(r['r']))):
+            rows.append((path, phase, label) + tuple(r[f] for f, _ in _FIELDS))
+        else:
+            pending.append(len(rows))
+            rows.append((path, phase, label))
+
+    if pending or catalog is None or len(rows) != len(catalog):
+        print('cataloging %i/%i images in %s' % (len(pending), len(images), directory))
+        tasks = [(os.path.join(directory, rows[i][0]), means) for i in pending]
+
+        if n_jobs == 1:
+            described = list(map(_describe_image, tasks))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                described = list(executor.map(_describe_image, tasks, chunksize=64))
+
+        for i, d in zip(pending, described):
+            rows[i] += d
+
+        catalog = structured_array(rows, [('path', str), ('phase', str), ('label', str)] + _FIELDS)
+        np.save(file_name, catalog)
+    else:
+        # Nothing changed: the catalog is marked as up to date. See `is_outdated`.
+        os.utime(file_name)
+
+    return catalog
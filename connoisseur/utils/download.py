@@ -0,0 +1,165 @@
+"""Resumable Downloads.
+
+Files are downloaded in segments, each one into a `{file}.{start}-{end}.part`
+file, which is resumed with an HTTP Range request if interrupted. Segments
+are downloaded concurrently, given that the server accepts Range requests.
+
+Author: Lucas David -- <lucasolivdavid@gmail.com>
+Licence: MIT License 2016 (c)
+
+"""
+
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib import error, request
+
+CHUNK_SIZE = 1024 ** 2
+
+
+def _resource_info(url):
+    """The size of the resource at `url` (0 if unknown) and whether its
+    server accepts Range requests."""
+    try:
+        with request.urlopen(request.Request(url, method='HEAD')) as r:
+            size = int(r.headers.get('Content-Length') or 0)
+            return size, r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    except error.HTTPError:
+        return 0, False
+
+
+def _part_file_name(file_name, start, end):
+    return '%s.%i-%s.part' % (file_name, start, '' if end is None else end)
+
+
+def _existing_parts(file_name):
+    directory, base = os.path.split(os.path.abspath(file_name))
+    pattern = re.compile(re.escape(base) + r'\.(\d+)-(\d*)\.part$')
+    parts = [pattern.match(f) for f in os.listdir(directory)]
+    return sorted((int(m.group(1)), int(m.group(2)) if m.group(2) else None)
+                  for m in parts if m)
+
+
+def _segments(file_name, size, n_segments):
+    """Split [0, size) into segments, reusing the ones of a previous run
+    if they still cover the whole file."""
+    existing = _existing_parts(file_name)
+    bounds = [start for start, _ in existing] + [existing[-1][1] if existing else None]
+
+    if (existing and bounds[0] == 0 and bounds[-1] == (size or None) and
+            all(end == bounds[i + 1] for i, (_, end) in enumerate(existing))):
+        return existing
+
+    for start, end in existing:
+        os.remove(_part_file_name(file_name, start, end))
+
+    if not size:
+        return [(0, None)]
+    bounds = [size * i // n_segments for i in range(n_segments + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(n_segments) if bounds[i] < bounds[i + 1]]
+
+
+def _download_segment(url, file_name, start, end, hash_name=None):
+    """Download the bytes [start, end) of `url` into `file_name`.
+
+    Bytes already in `file_name` are not downloaded again.
+
+    :return: the hash of `file_name`'s content, if `hash_name` is given.
+    """
+    done = os.path.getsize(file_name) if os.path.exists(file_name) else 0
+    hasher = hashlib.new(hash_name) if hash_name else None
+
+    if end is not None and start + done >= end:
+        if hasher is not None:
+            _update_hash(hasher, file_name)
+        return hasher
+
+    r = request.Request(url)
+    if start + done or end is not None:
+        r.add_header('Range', 'bytes=%i-%s' % (start + done, '' if end is None else end - 1))
+
+    with request.urlopen(r) as response:
+        if response.status != 206:
+            if start:
+                raise RuntimeError('%s does not accept Range requests.' % url)
+            # The whole file is being sent again.
+            done = 0
+
+        if done:
+            print('  resuming %s from byte %i' % (os.path.basename(file_name), start + done))
+            if hasher is not None:
+                _update_hash(hasher, file_name)
+
+        with open(file_name, 'ab' if done else 'wb') as f:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+
+    if end is not None and os.path.getsize(file_name) != end - start:
+        raise RuntimeError('incomplete segment %s: %i/%i bytes. Download again to resume it.'
+                           % (file_name, os.path.getsize(file_name), end - start))
+    return hasher
+
+
+def _update_hash(hasher, file_name):
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+
+
+def download(url, file_name, n_connections=1, expected_hash=None, hash_name='md5', resume=True):
+    """Download `url` into `file_name`, resuming previous attempts.
+
+    :param n_connections: int, the number of segments downloaded
+        concurrently. A single connection is used if the server does not
+        accept Range requests or does not inform the size of the file.
+    :param expected_hash: str, the hex digest `file_name` must have.
+        The file is removed and a `RuntimeError` is raised otherwise.
+    :param hash_name: str, the `hashlib` algorithm of `expected_hash`.
+    :param resume: bool, whether to resume from the segments of previous
+        attempts. These are discarded if False.
+    :return: str, the name of the downloaded file.
+    """
+    size, accepts_ranges = _resource_info(url)
+
+    if not accepts_ranges:
+        n_connections = 1
+    if not resume:
+        for start, end in _existing_parts(file_name):
+            os.remove(_part_file_name(file_name, start, end))
+
+    segments = _segments(file_name, size, n_connections)
+    parts = [_part_file_name(file_name, start, end) for start, end in segments]
+    hash_name = hash_name if expected_hash else None
+
+    if len(segments) == 1:
+        # The hash is computed as the data arrives.
+        hasher = _download_segment(url, parts[0], *segments[0], hash_name=hash_name)
+        os.replace(parts[0], file_name)
+    else:
+        with ThreadPoolExecutor(max_workers=n_connections) as executor:
+            list(executor.map(lambda a: _download_segment(url, *a),
+                              [(p, start, end) for p, (start, end) in zip(parts, segments)]))
+
+        # Segments are hashed while assembled.
+        hasher = hashlib.new(hash_name) if hash_name else None
+        with open(file_name, 'wb') as f:
+            for p in parts:
+                with open(p, 'rb') as part:
+                    for chunk in iter(lambda: part.read(CHUNK_SIZE), b''):
+                        f.write(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+        for p in parts:
+            os.remove(p)
+
+    if hasher is not None and hasher.hexdigest() != expected_hash.lower():
+        os.remove(file_name)
+        raise RuntimeError('%s hash mismatch: expected %s, got %s.'
+                           % (file_name, expected_hash, hasher.hexdigest()))
+    return file_name
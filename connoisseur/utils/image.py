@@ -1,17 +1,126 @@
+import atexit
+import hashlib
+import io
+import itertools
 import math
 import os
+import threading
+import time
+import zipfile
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from math import ceil
 
 import numpy as np
-from PIL import ImageEnhance
+from PIL import Image, ImageEnhance, ImageOps
+from keras import backend as K
 from keras.preprocessing import image as ki
 from keras.preprocessing.image import ImageDataGenerator
 from keras.utils.data_utils import Sequence
+from skimage import feature
+
+from .probe import IMAGE_EXTENSIONS
+from .shards import PatchShards, is_sharded
+from .splits import SplitManifest
+
+
+def load_img(path, grayscale=False, target_size=None, max_size=None,
+             resample=Image.NEAREST):
+    """Load an image, similarly to `keras.preprocessing.image.load_img`.
+
+    When a reduced image is requested, JPEGs are decoded directly at the
+    smallest DCT scale (1/2, 1/4 or 1/8) that is still larger than it
+    (`Image.draft`), instead of being fully decoded and then shrunk.
+
+    :param target_size: (height, width), the size of the image returned.
+    :param max_size: int, the maximum length of the largest side of the
+        image returned, whose aspect ratio is kept. Ignored when
+        `target_size` is passed.
+    :param resample: the PIL filter used to resize the decoded image.
+    :return: PIL Image.
+    """
+    img = Image.open(path)
+    mode = 'L' if grayscale else 'RGB'
+
+    size = None
+    if target_size is not None:
+        size = (target_size[1], target_size[0])
+    elif max_size and max(img.size) > max_size:
+        ratio = max_size / max(img.size)
+        size = tuple(max(1, int(s * ratio)) for s in img.size)
+
+    if size is not None:
+        img.draft(mode, size)
+    if img.mode != mode:
+        img = img.convert(mode)
+    if size is not None and img.size != size:
+        img = img.resize(size, resample)
+    return img
+
+
+_batch_executors = {}
+
+
+def _batch_executor(n_threads):
+    """A thread pool shared by the Sequences of this process.
+
+    Pools are created on first use, with the size asked by the caller,
+    and shut down when the process exits.
+    """
+    # Pools are not inherited by forked workers, so they are kept by pid.
+    key = os.getpid(), n_threads
+    if key not in _batch_executors:
+        _batch_executors[key] = ThreadPoolExecutor(max_workers=n_threads)
+    return _batch_executors[key]
+
+
+@atexit.register
+def _shutdown_batch_executors():
+    pid = os.getpid()
+    for key in [k for k in _batch_executors if k[0] == pid]:
+        _batch_executors.pop(key).shutdown(wait=False)
+
+
+def load_batch(load, items, n_threads=1):
+    """Load a batch of images into a preallocated array.
+
+    PIL releases the GIL while decoding and resizing, so `n_threads` threads
+    load the images of a batch concurrently.
+
+    :param load: function mapping an item to an image array.
+    :param items: list of items (e.g. file names).
+    :return: array shaped as (len(items), *image_shape).
+    """
+    x = load(items[0])
+    x_batch = np.empty((len(items),) + x.shape, dtype=K.floatx())
+    x_batch[0] = x
+
+    def _load(i):
+        x_batch[i] = load(items[i])
+
+    if n_threads > 1:
+        list(_batch_executor(n_threads).map(_load, range(1, len(items))))
+    else:
+        for i in range(1, len(items)):
+            _load(i)
+    return x_batch
+
+
+def _load_transformed(filename, target_size, image_data_generator):
+    x = ki.img_to_array(load_img(filename, target_size=target_size))
+    x = image_data_generator.random_transform(x)
+    return image_data_generator.standardize(x)
 
 
 class MultipleOutputsDirectorySequence(Sequence):
     """Iterator capable of creating (images, {painters, styles, ...}) pairs
        from a directory.
+
+    :param n_threads: int, the number of threads loading the images of a
+        batch. See `load_batch`.
+    :param split: `SplitManifest` or the name of its file. If given, the
+        images are the ones of the `train` folder and only the ones of the
+        `subset` phase are iterated over. See `PatchesSequence`.
     """
 
     def __init__(self, directory,
@@ -21,8 +130,12 @@ class MultipleOutputsDirectorySequence(Sequence):
                  batch_size: int = 32,
                  target_size=None,
                  subdirectories=None,
-                 shuffle: bool = True):
+                 shuffle: bool = True,
+                 n_threads: int = 1,
+                 split=None,
+                 subset=None):
         self.directory = directory
+        self.n_threads = n_threads
         self.outputs = outputs
         self.name_map = name_map
         self.image_data_generator = image_data_generator
@@ -30,16 +143,11 @@ class MultipleOutputsDirectorySequence(Sequence):
         self.target_size = target_size
         self.shuffle = shuffle
 
-        samples = []
-        if not directory.endswith('/'):
-            directory += '/'
-
         if isinstance(subdirectories, int) or subdirectories is None:
-            subdirectories = sorted(os.listdir(directory))[:subdirectories]
+            subdirectories = list_label_folders(directory)[:subdirectories]
 
         self.subdirectories = subdirectories
-        for c in self.subdirectories:
-            samples += [directory + c + '/' + f for f in os.listdir(directory + c)]
+        samples = list(itertools.chain(*_label_files(directory, subdirectories, split, subset).values()))
 
         if self.shuffle:
             np.random.shuffle(samples)
@@ -57,41 +165,41 @@ class MultipleOutputsDirectorySequence(Sequence):
         f_batch = self.samples[idx * self.batch_size:(idx + 1) * self.batch_size]
         y_batch = self.classes[idx * self.batch_size:(idx + 1) * self.batch_size]
 
-        x_batch = []
-        for filename in f_batch:
-            x = ki.img_to_array(ki.load_img(filename, target_size=self.target_size))
-            x = self.image_data_generator.random_transform(x)
-            x = self.image_data_generator.standardize(x)
-            x_batch += [x]
-
+        x_batch = load_batch(self._load, f_batch, self.n_threads)
         y_batch = {o: y[y_batch] for o, y in self.outputs.items()}
-        return np.asarray(x_batch), y_batch
+        return x_batch, y_batch
+
+    def _load(self, filename):
+        return _load_transformed(filename, self.target_size, self.image_data_generator)
 
 
 class BalancedDirectoryPairsSequence(Sequence):
     """Iterator capable of creating pairs of images.
 
     :param batch_size: size of the batch yielded each next(self) call.
+    :param n_threads: int, the number of threads loading the images of a
+        batch. See `load_batch`.
+    :param split: `SplitManifest` or the name of its file. If given, the
+        images are the ones of the `train` folder and only the ones of the
+        `subset` phase are iterated over. See `PatchesSequence`.
     """
 
     def __init__(self, directory, image_data_generator, batch_size=32,
-                 pairs=50, target_size=None, classes=None, shuffle=True):
+                 pairs=50, target_size=None, classes=None, shuffle=True,
+                 n_threads=1, split=None, subset=None):
         self.directory = directory
+        self.n_threads = n_threads
         self.image_data_generator = image_data_generator
         self.batch_size = batch_size
         self.target_size = target_size
-        self.classes = np.asarray(classes or sorted(os.listdir(directory)))
+        self.classes = np.asarray(classes or list_label_folders(directory))
         self.shuffle = shuffle
 
-        if not directory.endswith('/'):
-            directory += '/'
-
         _id = 0
         samples = {}
-        for c in self.classes:
-            files = os.listdir(directory + c)
+        for files in _label_files(directory, self.classes, split, subset).values():
             if files:
-                samples[_id] = list(map(lambda _f: directory + c + '/' + _f, files))
+                samples[_id] = files
                 _id += 1
 
         x, y = [], []
@@ -116,23 +224,22 @@ class BalancedDirectoryPairsSequence(Sequence):
         batch_files = self.x[idx * self.batch_size:(idx + 1) * self.batch_size]
         batch_y = self.y[idx * self.batch_size:(idx + 1) * self.batch_size]
 
-        batch_x = [[], []]
-        # build batch of image data
-        for a, b in batch_files:
-            for i, n in enumerate((a, b)):
-                x = ki.img_to_array(ki.load_img(n, target_size=self.target_size))
-                x = self.image_data_generator.random_transform(x)
-                x = self.image_data_generator.standardize(x)
-                batch_x[i] += [x]
-
-        batch_x = [np.asarray(_x) for _x in batch_x]
+        batch_x = [load_batch(self._load, batch_files[:, i], self.n_threads) for i in (0, 1)]
         return batch_x, np.array(batch_y)
 
+    def _load(self, filename):
+        return _load_transformed(filename, self.target_size, self.image_data_generator)
+
 
 class BalancedDirectoryPairsMultipleOutputsSequence(Sequence):
     """Iterator capable of creating pairs of images.
 
     :param batch_size: size of the batch yielded each next(self) call.
+    :param n_threads: int, the number of threads loading the images of a
+        batch. See `load_batch`.
+    :param split: `SplitManifest` or the name of its file. If given, the
+        images are the ones of the `train` folder and only the ones of the
+        `subset` phase are iterated over. See `PatchesSequence`.
     """
 
     def __init__(self, directory,
@@ -143,8 +250,12 @@ class BalancedDirectoryPairsMultipleOutputsSequence(Sequence):
                  target_size=None,
                  subdirectories=None,
                  shuffle: bool = True,
-                 pairs=50):
+                 pairs=50,
+                 n_threads: int = 1,
+                 split=None,
+                 subset=None):
         self.directory = directory
+        self.n_threads = n_threads
         self.outputs = outputs
         self.name_map = name_map
         self.image_data_generator = image_data_generator
@@ -152,16 +263,13 @@ class BalancedDirectoryPairsMultipleOutputsSequence(Sequence):
         self.target_size = target_size
         self.shuffle = shuffle
 
-        if not directory.endswith('/'):
-            directory += '/'
-        self.subdirectories = np.asarray(subdirectories or sorted(os.listdir(directory)))
+        self.subdirectories = np.asarray(subdirectories or list_label_folders(directory))
 
         _id = 0
         samples = {}
-        for c in self.subdirectories:
-            files = os.listdir(directory + c)
+        for files in _label_files(directory, self.subdirectories, split, subset).values():
             if files:
-                samples[_id] = list(map(lambda _f: directory + c + '/' + _f, files))
+                samples[_id] = files
                 _id += 1
 
         x = []
@@ -184,6 +292,10 @@ class BalancedDirectoryPairsMultipleOutputsSequence(Sequence):
             print('processing', o)
 
             _y = outputs[o]
+            if hasattr(_y, 'codes'):
+                # One-hot codes (see `load_multiple_outputs`) are compared by
+                # their integer codes, never expanded.
+                _y = _y.codes.reshape(-1, 1)
             _y = _y[indices]
 
             print(_y.shape)
@@ -205,18 +317,12 @@ class BalancedDirectoryPairsMultipleOutputsSequence(Sequence):
         y_batch = {o + '_binary_predictions': y[idx * self.batch_size:(idx + 1) * self.batch_size]
                    for o, y in self.y.items()}
 
-        x_batch = [[], []]
-        # build batch of image data
-        for a, b in f_batch:
-            for i, n in enumerate((a, b)):
-                x = ki.img_to_array(ki.load_img(n, target_size=self.target_size))
-                x = self.image_data_generator.random_transform(x)
-                x = self.image_data_generator.standardize(x)
-                x_batch[i] += [x]
-
-        x_batch = [np.asarray(_x) for _x in x_batch]
+        x_batch = [load_batch(self._load, f_batch[:, i], self.n_threads) for i in (0, 1)]
         return x_batch, y_batch
 
+    def _load(self, filename):
+        return _load_transformed(filename, self.target_size, self.image_data_generator)
+
 
 class ArrayPairsSequence(Sequence):
     def __init__(self, samples, names, pairs, labels, batch_size):
@@ -248,6 +354,785 @@ class ArrayPairsSequence(Sequence):
         return zb, yb
 
 
+def encode_labels(y, class_mode, num_classes):
+    """Encode label indices `y` the same way keras' directory iterators do."""
+    if class_mode == 'categorical':
+        y_batch = np.zeros((len(y), num_classes), dtype=K.floatx())
+        y_batch[np.arange(len(y)), y] = 1.
+        return y_batch
+
+    return np.asarray(y).astype(K.floatx())
+
+
+class PatchesSequence(Sequence):
+    """Base iterator over labeled patches.
+
+    Mirrors the iterators returned by `ImageDataGenerator.flow_from_directory`
+    (`n`, `filenames`, `classes`, `class_indices`, `next(...)`). Subclasses
+    define how each patch is loaded through `load_patch`.
+
+    :param filenames: array of names, following `{label}/{painting}-{id}.jpg`.
+    :param labels: array, the label of each patch.
+    :param class_mode: one of 'categorical', 'binary', 'sparse' or None.
+    :param split: `SplitManifest` or the name of its file. If given, the
+        patches are the ones of the `train` folder and only the patches of
+        the `subset` phase are iterated over.
+    :param subset: str, the phase iterated over. Defaults to 'train'.
+    """
+
+    def __init__(self, filenames, labels,
+                 image_data_generator: ImageDataGenerator,
+                 batch_size: int = 32,
+                 target_size=(256, 256),
+                 classes=None,
+                 class_mode='categorical',
+                 shuffle: bool = True,
+                 seed=None,
+                 split=None,
+                 subset=None):
+        self.image_data_generator = image_data_generator
+        self.batch_size = batch_size
+        self.target_size = tuple(target_size)
+        self.class_mode = class_mode
+        self.shuffle = shuffle
+        self.random_state = np.random.RandomState(seed)
+
+        labels = np.asarray(labels)
+        if classes is None:
+            classes = sorted(set(labels))
+        self.class_indices = {c: i for i, c in enumerate(classes)}
+        self.num_classes = len(classes)
+
+        s = np.in1d(labels, classes)
+        if split is not None:
+            s &= _as_split(split).mask(subset or 'train', filenames, patches=True)
+        self.samples, = np.where(s)
+        self.classes = np.asarray([self.class_indices[c] for c in labels[self.samples]], dtype=int)
+        self.filenames = np.asarray(filenames)[self.samples].tolist()
+        self.n = len(self.samples)
+
+        self.index_array = np.arange(self.n)
+        self.batch_index = 0
+        self.on_epoch_end()
+
+        print('Found %i images belonging to %i classes.' % (self.n, self.num_classes))
+
+    def load_patch(self, i):
+        """Load the `i`-th patch (out of all filenames) as a (height, width, 3) array."""
+        raise NotImplementedError
+
+    def __len__(self):
+        return math.ceil(self.n / self.batch_size)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.index_array = self.random_state.permutation(self.n)
+
+    def __getitem__(self, idx):
+        batch = self.index_array[idx * self.batch_size:(idx + 1) * self.batch_size]
+
+        x_batch = np.zeros((len(batch),) + self.target_size + (3,), dtype=K.floatx())
+        for i, j in enumerate(batch):
+            x = self.load_patch(self.samples[j]).astype(K.floatx())
+            x = self.image_data_generator.random_transform(x)
+            x = self.image_data_generator.standardize(x)
+            x_batch[i] = x
+
+        if self.class_mode is None:
+            return x_batch
+
+        return x_batch, encode_labels(self.classes[batch], self.class_mode, self.num_classes)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.batch_index >= len(self):
+            self.batch_index = 0
+            self.on_epoch_end()
+
+        batch = self[self.batch_index]
+        self.batch_index += 1
+        return batch
+
+    next = __next__
+
+
+class DirectoryPatchesSequence(PatchesSequence):
+    """Iterator over the patch files in a directory, organized in label folders.
+
+    :param directory: str, the patches' phase directory.
+    """
+
+    def __init__(self, directory, image_data_generator, classes=None, **kwargs):
+        self.directory = directory
+        self.all_filenames, labels = list_labeled_images(directory, classes)
+        super().__init__(self.all_filenames, labels, image_data_generator, classes=classes, **kwargs)
+
+    def load_patch(self, i):
+        return ki.img_to_array(load_img(os.path.join(self.directory, self.all_filenames[i]),
+                                        target_size=self.target_size))
+
+
+class ShardedPatchesSequence(PatchesSequence):
+    """Iterator over the patches packed by
+       `DataSet.save_patches_to_disk(output='shards')`.
+
+    :param directory: str, the sharded phase directory.
+    """
+
+    def __init__(self, directory, image_data_generator, **kwargs):
+        self.directory = directory
+        self.shards = PatchShards(directory)
+        super().__init__(self.shards.names, self.shards.labels, image_data_generator, **kwargs)
+
+    def load_patch(self, i):
+        return ki.img_to_array(self.shards.load_img(i, target_size=self.target_size))
+
+
+def _as_split(split):
+    return split if isinstance(split, SplitManifest) else SplitManifest.load(split)
+
+
+def list_label_folders(directory):
+    """List the label folders in `directory`, ignoring files (e.g. the
+    extraction manifest and shard indexes) and hidden folders."""
+    return sorted(c for c in os.listdir(directory)
+                  if not c.startswith('.') and os.path.isdir(os.path.join(directory, c)))
+
+
+def list_labeled_images(directory, classes=None):
+    """List the images in `directory`, organized in label folders.
+
+    :return: (filenames, labels), the images' paths relative to `directory`
+        and their labels, sorted by label and name.
+    """
+    classes = classes or list_label_folders(directory)
+    filenames, labels = [], []
+
+    for c in classes:
+        files = sorted(f for f in os.listdir(os.path.join(directory, c))
+                       if f.lower().endswith(IMAGE_EXTENSIONS))
+        filenames += [c + '/' + f for f in files]
+        labels += len(files) * [c]
+
+    return filenames, labels
+
+
+def _label_files(directory, classes, split=None, subset=None):
+    """The paths of the images in each label folder of `directory`.
+
+    :param split: `SplitManifest` or the name of its file. If given,
+        `directory` is a `train` folder of patches, of which only the ones
+        of the `subset` phase (default: 'train') are listed.
+    :return: OrderedDict {label: paths}, following `classes`.
+    """
+    filenames, labels = list_labeled_images(directory, list(classes))
+    if split is not None:
+        s = _as_split(split).mask(subset or 'train', filenames, patches=True)
+        filenames, labels = itertools.compress(filenames, s), itertools.compress(labels, s)
+
+    files = OrderedDict((c, []) for c in classes)
+    for f, c in zip(filenames, labels):
+        files[c].append(os.path.join(directory, f))
+    return files
+
+
+def list_labeled_archive_images(archive, directory, classes=None):
+    """List the images in `directory`, within a zip `archive`.
+
+    :param archive: zipfile.ZipFile, the archive.
+    :param directory: str, the path of the directory inside the archive,
+        organized in label folders.
+    :return: (filenames, labels), as in `list_labeled_images`.
+    """
+    prefix = directory.strip('/') + '/'
+    images = defaultdict(list)
+
+    for n in archive.namelist():
+        if n.startswith(prefix) and n.lower().endswith(IMAGE_EXTENSIONS):
+            label, _, f = n[len(prefix):].partition('/')
+            if f and '/' not in f:
+                images[label].append(f)
+
+    filenames, labels = [], []
+    for c in classes or sorted(images):
+        files = sorted(images[c])
+        filenames += [c + '/' + f for f in files]
+        labels += len(files) * [c]
+
+    return filenames, labels
+
+
+class CachedPatchesSequence(PatchesSequence):
+    """Iterator over patches decoded only once.
+
+    Patches (either files or shards) are decoded into a memory-mapped uint8
+    array shaped as (patches, height, width, 3) the first time the directory
+    is iterated. Following iterations (e.g. training epochs) read from this
+    array directly. Augmentation is still performed for each batch.
+
+    The cache is identified by the names, sizes and modification times of
+    the patches, and by `target_size`. A new cache is built if any changes.
+
+    :param directory: str, the patches' phase directory.
+    :param cache_dir: str, the directory in which caches are stored.
+        Defaults to a `.patches-cache` folder next to `directory`.
+    """
+
+    def __init__(self, directory, image_data_generator, cache_dir=None,
+                 target_size=(256, 256), classes=None, **kwargs):
+        self.directory = directory
+        self.cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.normpath(directory)),
+                                                   '.patches-cache')
+
+        if is_sharded(directory):
+            source = PatchShards(directory)
+            filenames, labels = source.names, source.labels
+            stats = [source.index.tobytes()]
+            load = lambda i: source.load_img(i, target_size=target_size)
+        else:
+            filenames, labels = list_labeled_images(directory, classes)
+            stats = [(f, os.stat(os.path.join(directory, f))) for f in filenames]
+            stats = ['%s:%i:%i' % (f, s.st_size, s.st_mtime_ns) for f, s in stats]
+            load = lambda i: load_img(os.path.join(directory, filenames[i]), target_size=target_size)
+
+        key = hashlib.sha1(repr(tuple(target_size)).encode())
+        for s in stats:
+            key.update(s if isinstance(s, bytes) else s.encode())
+        self.cache_file = os.path.join(self.cache_dir, '%s.npy' % key.hexdigest())
+
+        if not os.path.exists(self.cache_file):
+            self._build(load, len(filenames), target_size)
+        self.images = np.load(self.cache_file, mmap_mode='r')
+
+        super().__init__(filenames, labels, image_data_generator,
+                         target_size=target_size, classes=classes, **kwargs)
+
+    def _build(self, load, n_patches, target_size):
+        print('caching %i patches into %s' % (n_patches, self.cache_file))
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        partial_file = self.cache_file + '.partial'
+        images = np.lib.format.open_memmap(partial_file, mode='w+', dtype=np.uint8,
+                                           shape=(n_patches,) + tuple(target_size) + (3,))
+        for i in range(n_patches):
+            images[i] = np.asarray(load(i), dtype=np.uint8)
+        images.flush()
+        del images
+
+        # Only complete caches are ever found under the final name.
+        os.replace(partial_file, self.cache_file)
+
+    def load_patch(self, i):
+        return self.images[i]
+
+
+class VirtualPatchesSequence(Sequence):
+    """Iterator over random patches cropped from full paintings on the fly.
+
+    No patches need to be extracted beforehand. Each batch is formed by
+    sampling paintings and a patch from each one of them, following the same
+    modes as `DataSet.save_patches_to_disk`. Decoded (and optionally
+    down-scaled) paintings are kept in a LRU cache, together with their patch
+    probabilities in the gradient modes.
+
+    :param directory: str, the paintings' phase directory, organized in label
+        folders.
+    :param archive: str, a zip file from which paintings are read, without
+        being extracted. `directory` is then the path of the phase inside it.
+    :param split: `SplitManifest` or the name of its file. If given,
+        `directory` is the `train` folder and only the paintings of the
+        `subset` phase are sampled.
+    :param subset: str, the phase sampled. Defaults to 'train'.
+    :param mode: str, how patches are sampled. Options are:
+        * 'random': paintings are sampled uniformly and patches are cropped
+            from random positions.
+        * 'balanced': same as 'random', but all labels are equally likely.
+        * 'max-gradient' and 'min-gradient': paintings are sampled uniformly
+            and patches are cropped according to the edges they contain.
+    :param target_size: (height, width), the size of the patches.
+    :param patches_per_epoch: int, the number of patches in each epoch.
+        Defaults to one patch per painting.
+    :param max_cached: int, maximum number of paintings kept decoded.
+    :param max_size: int, paintings are down-scaled until their largest
+        dimension is at most `max_size` pixels. Ignored if None.
+    :param class_mode: one of 'categorical', 'binary', 'sparse' or None.
+    :param seed: int, seed from which the patches of each batch are sampled.
+        Batches are reproducible, regardless of the order they are requested.
+    """
+
+    def __init__(self, directory,
+                 image_data_generator: ImageDataGenerator,
+                 mode='random',
+                 batch_size: int = 32,
+                 target_size=(256, 256),
+                 patches_per_epoch: int = None,
+                 max_cached: int = 256,
+                 max_size: int = None,
+                 classes=None,
+                 class_mode='categorical',
+                 low_threshold=.9,
+                 pool_size=1,
+                 seed=None,
+                 archive=None,
+                 split=None,
+                 subset=None):
+        if mode not in ('random', 'balanced', 'max-gradient', 'min-gradient'):
+            raise ValueError('unknown mode %s' % mode)
+        if archive is not None and not zipfile.is_zipfile(archive):
+            raise ValueError('%s is not a zip file. Paintings can only be '
+                             'read from zip archives.' % archive)
+
+        self.directory = directory
+        self.image_data_generator = image_data_generator
+        self.mode = mode
+        self.batch_size = batch_size
+        self.target_size = tuple(target_size)
+        self.max_cached = max_cached
+        self.max_size = max_size
+        self.class_mode = class_mode
+        self.low_threshold = low_threshold
+        self.pool_size = pool_size
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+
+        self.archive = archive and zipfile.ZipFile(archive)
+        filenames, labels = (list_labeled_archive_images(self.archive, directory, classes)
+                             if self.archive else list_labeled_images(directory, classes))
+        if split is not None:
+            s = _as_split(split).mask(subset or 'train', filenames)
+            filenames, labels = np.asarray(filenames)[s].tolist(), np.asarray(labels)[s].tolist()
+        classes = classes or sorted(set(labels))
+        self.class_indices = {c: i for i, c in enumerate(classes)}
+        self.num_classes = len(classes)
+        self.filenames = filenames
+        self.classes = np.asarray([self.class_indices[c] for c in labels], dtype=int)
+        self.n = patches_per_epoch or len(filenames)
+
+        if mode == 'balanced':
+            counts = np.bincount(self.classes, minlength=self.num_classes)
+            self.p = 1. / counts[self.classes]
+            self.p /= self.p.sum()
+        else:
+            self.p = None
+
+        self.epoch = 0
+        self.batch_index = 0
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        print('Found %i images belonging to %i classes.' % (len(filenames), self.num_classes))
+
+    def __len__(self):
+        return math.ceil(self.n / self.batch_size)
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+    def _load_painting(self, i):
+        with self._cache_lock:
+            if i in self._cache:
+                self._cache.move_to_end(i)
+                return self._cache[i]
+
+        # PIL (width, height) patch size.
+        patch_size = self.target_size[::-1]
+
+        if self.archive:
+            f = io.BytesIO(self.archive.read(self.directory.strip('/') + '/' + self.filenames[i]))
+        else:
+            f = os.path.join(self.directory, self.filenames[i])
+
+        image = load_img(f, max_size=self.max_size, resample=Image.BICUBIC)
+        image = pad_to_patch_size(image, patch_size)
+
+        p = None
+        if self.mode in ('max-gradient', 'min-gradient'):
+            p = patch_probabilities(image, self.mode, patch_size,
+                                    low_threshold=self.low_threshold,
+                                    pool_size=self.pool_size)
+
+        with self._cache_lock:
+            self._cache[i] = image, p
+            if len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+        return image, p
+
+    def __getitem__(self, idx):
+        r = np.random.RandomState([self.seed, self.epoch, idx])
+        batch_size = min(self.batch_size, self.n - idx * self.batch_size)
+        batch = r.choice(len(self.filenames), size=batch_size, p=self.p)
+        patch_size = self.target_size[::-1]
+
+        x_batch = np.zeros((batch_size,) + self.target_size + (3,), dtype=K.floatx())
+        for i, j in enumerate(batch):
+            image, p = self._load_painting(j)
+            (s_w, s_h), = patch_starting_points(image, self.mode, patch_size, 1,
+                                                random_state=r, p=p, pool_size=self.pool_size)
+            x = ki.img_to_array(image.crop((s_w, s_h, s_w + patch_size[0], s_h + patch_size[1])))
+            x = self.image_data_generator.random_transform(x)
+            x = self.image_data_generator.standardize(x)
+            x_batch[i] = x
+
+        if self.class_mode is None:
+            return x_batch
+
+        return x_batch, encode_labels(self.classes[batch], self.class_mode, self.num_classes)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.batch_index >= len(self):
+            self.batch_index = 0
+            self.on_epoch_end()
+
+        batch = self[self.batch_index]
+        self.batch_index += 1
+        return batch
+
+    next = __next__
+
+
+def gradient_scores(e, patch_size, pool_size=1):
+    """Sum the edges inside every patch-sized window of `e`.
+
+    Every window is scored in O(1) from a summed-area table of the edge map.
+    If `pool_size > 1`, `e` is first average-pooled, reproducing the graph
+    built for the 'tensorflow' backend of `DataSet.save_patches_to_disk`.
+
+    :param e: array shaped as (height, width), the edge map.
+    :param patch_size: the size of the windows, in pixels.
+    :param pool_size: int, the size of the average pooling.
+    :return: array, the score of each window in (pooled) `e`, with the
+        shape of a valid convolution of `e` with the window.
+    """
+    if pool_size > 1:
+        h, w = (np.array(e.shape) // pool_size) * pool_size
+        e = e[:h, :w].reshape(h // pool_size, pool_size, w // pool_size, pool_size).mean(axis=(1, 3))
+
+    # Binary edge maps are summed exactly, with integers.
+    t = np.zeros((e.shape[0] + 1, e.shape[1] + 1),
+                 dtype=np.float64 if np.issubdtype(e.dtype, np.floating) else np.int64)
+    np.cumsum(e, axis=0, dtype=t.dtype, out=t[1:, 1:])
+    np.cumsum(t[1:, 1:], axis=1, out=t[1:, 1:])
+
+    kh, kw = patch_size[0] // pool_size, patch_size[1] // pool_size
+    return t[kh:, kw:] - t[:-kh, kw:] - t[kh:, :-kw] + t[:-kh, :-kw]
+
+
+def pad_to_patch_size(image, patch_size):
+    """Pad `image` with borders if it is smaller than `patch_size` in any
+    dimension, making sure at least one patch can be extracted from it."""
+    border = np.array(patch_size) - image.size
+
+    if np.any(border > 0):
+        border = np.ceil(border.clip(0, border.max()) / 2).astype(np.int)
+        image = ImageOps.expand(image, border=tuple(border))
+    return image
+
+
+def patch_probabilities(image, mode, patch_size, low_threshold=.9, pool_size=1, tensors=None):
+    """Probability of selecting each patch of `image` in the gradient modes.
+
+    :param mode: str, either 'max-gradient' or 'min-gradient'.
+    :param tensors: (x, y), the input and output of a TensorFlow graph
+        scoring the patches. `gradient_scores` is used if None.
+    :return: array, the probability of selecting each window of the (pooled)
+        edges of `image`. See `gradient_scores`.
+    """
+    gray_image = image.convert('L')
+    gray_tensor = ki.img_to_array(gray_image).squeeze(-1)
+    e = feature.canny(gray_tensor, low_threshold=low_threshold, use_quantiles=True)
+
+    if tensors is not None:
+        x, y = tensors
+
+        p = y.eval(feed_dict={x: e.astype(np.float).reshape((1,) + e.shape + (1,))})
+        p = p.squeeze((0, -1))
+    else:
+        p = gradient_scores(e, patch_size, pool_size)
+
+    p = p.astype(np.float)
+    p = np.exp(p / p.sum())
+    p /= p.sum()
+
+    if mode == 'min-gradient':
+        p = 1 - p
+        p /= p.sum()
+    return p
+
+
+def _window_origins(c, patch_size, pool_size=1):
+    """Map windows (row, column) scored by `gradient_scores` to the
+    (left, top) coordinates of the patches centered on them."""
+    c = np.asarray(c).astype(np.int)
+    c += np.array(patch_size) // (2 * pool_size)  # restore sizes before convolution
+    c *= pool_size  # restore sizes before max_pooling2d
+    c -= np.array(patch_size) // 2  # center selected pixels
+
+    return np.array([c[:, 1], c[:, 0]]).T
+
+
+def patch_starting_points(image, mode, patch_size, n_patches, random_state=np.random, p=None, pool_size=1):
+    """Select the (left, top) coordinates of patches in `image`.
+
+    :param mode: str, one of 'random', 'balanced', 'max-gradient',
+        'min-gradient' or 'all'. See `DataSet.save_patches_to_disk`.
+    :param p: array, the probabilities given by `patch_probabilities`.
+        Required by the gradient modes.
+    :return: iterable of (left, top) coordinates.
+    """
+    if mode in ('min-gradient', 'max-gradient'):
+        c = random_state.choice(np.arange(np.product(p.shape)), size=(n_patches, 1), p=p.flatten())
+        c = np.concatenate((c // p.shape[1], c % p.shape[1]), axis=-1)
+        return _window_origins(c, patch_size, pool_size)
+
+    if mode in ('random', 'balanced'):
+        return (
+            random_state.rand(n_patches, 2)
+            * (image.width - patch_size[0], image.height - patch_size[1])
+        ).astype(np.int)
+
+    if mode == 'all':
+        d_widths = list(range(0, image.width - patch_size[0] + 1, patch_size[0]))
+        d_heights = list(range(0, image.height - patch_size[1] + 1, patch_size[1]))
+        return itertools.product(d_widths, d_heights)
+
+    raise ValueError('unknown mode %s' % mode)
+
+
+def gradient_tiles(image_size, patch_size, max_pixels, pool_size=1, margin=8):
+    """Split the windows scored by `gradient_scores` into tiles.
+
+    The image region read to score the windows of a tile, including a
+    `margin` in which edges are detected but discarded, has at most
+    `max_pixels` pixels. Neighbouring regions overlap by a patch.
+
+    :param image_size: (width, height), the size of the image.
+    :return: list of (top, left, bottom, right) boxes over the windows.
+    """
+    width, height = image_size
+    kh, kw = patch_size[0] // pool_size, patch_size[1] // pool_size
+    rows, cols = height // pool_size - kh + 1, width // pool_size - kw + 1
+
+    side = (int(max_pixels ** .5) - 2 * margin) // pool_size
+    tile_rows, tile_cols = side - kh + 1, side - kw + 1
+
+    if tile_rows < 1 or tile_cols < 1:
+        raise ValueError('max_pixels=%i cannot fit a patch of size %s (plus a margin of %i).'
+                         % (max_pixels, patch_size, margin))
+
+    return [(top, left, min(top + tile_rows, rows), min(left + tile_cols, cols))
+            for top in range(0, rows, tile_rows)
+            for left in range(0, cols, tile_cols)]
+
+
+def _tile_edge_counts(image, tile, patch_size, low_threshold, pool_size, margin=8):
+    """Count the edges of `image` within each window of `tile`.
+
+    :return: int array shaped as the windows of `tile`.
+    """
+    top, left, bottom, right = tile
+    kh, kw = patch_size[0] // pool_size, patch_size[1] // pool_size
+
+    y0, x0 = top * pool_size, left * pool_size
+    y1, x1 = (bottom + kh - 1) * pool_size, (right + kw - 1) * pool_size
+    my0, mx0 = max(y0 - margin, 0), max(x0 - margin, 0)
+    my1, mx1 = min(y1 + margin, image.height), min(x1 + margin, image.width)
+
+    gray_tensor = ki.img_to_array(image.crop((mx0, my0, mx1, my1)).convert('L')).squeeze(-1)
+    e = feature.canny(gray_tensor, low_threshold=low_threshold, use_quantiles=True)
+    e = e[y0 - my0:y1 - my0, x0 - mx0:x1 - mx0]
+
+    # Pooled scores are averages: multiply them back into edge counts.
+    return np.rint(gradient_scores(e, patch_size, pool_size) * pool_size ** 2).astype(np.int64)
+
+
+def tiled_patch_starting_points(image, mode, patch_size, n_patches, max_pixels,
+                                random_state=np.random, low_threshold=.9, pool_size=1):
+    """Select patches in the gradient modes, scoring `image` in tiles.
+
+    Equivalent to `patch_probabilities` followed by `patch_starting_points`,
+    except that edges are detected and windows are scored one tile at a
+    time (see `gradient_tiles`), so memory is bounded by `max_pixels`
+    regardless of the size of `image`. Canny's thresholds are computed from
+    the quantiles of each tile, though.
+
+    The first pass over the tiles histograms their scores, which is enough
+    to normalize the probabilities and to draw how many patches come from
+    each tile. The second pass scores the tiles again and draws the patches.
+
+    :return: array of (left, top) coordinates.
+    """
+    tiles = gradient_tiles(image.size, patch_size, max_pixels, pool_size)
+
+    def counts(tile):
+        return _tile_edge_counts(image, tile, patch_size, low_threshold, pool_size)
+
+    histograms = [np.bincount(counts(t).ravel()) for t in tiles]
+    n_bins = max(len(h) for h in histograms)
+    histograms = np.array([np.pad(h, (0, n_bins - len(h)), 'constant') for h in histograms])
+
+    scores = np.arange(n_bins) / pool_size ** 2
+    total = scores @ histograms.sum(axis=0)
+    w = np.exp(scores / total) if total else np.ones(n_bins)
+
+    if mode == 'min-gradient':
+        w = 1 - w / (histograms.sum(axis=0) @ w)
+
+    masses = histograms @ w
+    n_tile_patches = random_state.multinomial(n_patches, masses / masses.sum())
+
+    c = []
+    for (top, left, bottom, right), n in zip(tiles, n_tile_patches):
+        if n:
+            p = w[counts((top, left, bottom, right))].ravel()
+            ix = random_state.choice(len(p), size=n, p=p / p.sum())
+            c.append(np.stack((top + ix // (right - left), left + ix % (right - left)), axis=-1))
+
+    c = np.concatenate(c)[random_state.permutation(n_patches)]
+    return _window_origins(c, patch_size, pool_size)
+
+
+def flow_from_patches(image_data_generator, directory, cache_dir=None, **kwargs):
+    """Iterate over the patches in `directory`, whether sharded or not.
+
+    :param cache_dir: str, if given, patches are decoded only once into a
+        cache within this directory. See `CachedPatchesSequence`.
+    :return: a `CachedPatchesSequence` if `cache_dir` is given, a
+        `ShardedPatchesSequence` if the patches in `directory` were packed
+        into shards, a `DirectoryPatchesSequence` if a `split` manifest is
+        given, or `image_data_generator.flow_from_directory`'s iterator
+        otherwise.
+    """
+    if cache_dir:
+        return CachedPatchesSequence(directory, image_data_generator, cache_dir=cache_dir, **kwargs)
+
+    if is_sharded(directory):
+        return ShardedPatchesSequence(directory, image_data_generator, **kwargs)
+
+    if kwargs.get('split') is not None:
+        return DirectoryPatchesSequence(directory, image_data_generator, **kwargs)
+
+    return image_data_generator.flow_from_directory(directory, **kwargs)
+
+
+class Prefetcher:
+    """Prefetcher.
+
+    Loads the batches of `data` ahead, in background threads, while the
+    current one is being consumed (e.g. by `model.predict_on_batch`).
+    Batches are delivered in order, as `next(data)` would.
+
+    Batches of a `Sequence` (such as the iterators of `flow_from_patches`)
+    are loaded by index, concurrently. Once an epoch is over, its batches
+    are consumed before `on_epoch_end` is called and the next epoch starts.
+    Other iterators are read by a single thread.
+
+    Other attributes (e.g. `n`, `filenames`) are those of `data`.
+
+    Parameters
+    ----------
+    data: keras `Sequence` or iterator, the batches.
+    depth: int, the maximum number of batches loaded ahead.
+    workers: int, the number of threads loading batches of a `Sequence`.
+    epochs: int, the number of epochs of a `Sequence` loaded, after which
+        `StopIteration` is raised. Unlimited if None.
+
+    Attributes
+    ----------
+    batches: int, the number of batches delivered.
+    stalls: int, the number of batches that were not ready when requested.
+    stall_time: float, the time (in seconds) spent waiting for them.
+    full: int, the number of requests made when all `depth` batches were
+        ready, i.e. the workers were idle waiting for room.
+    """
+
+    def __init__(self, data, depth=4, workers=1, epochs=None):
+        self.data = data
+        self.depth = depth
+        self.is_sequence = isinstance(data, Sequence)
+        self.workers = workers if self.is_sequence else 1
+        self.epochs = epochs
+
+        self.batches = 0
+        self.stalls = 0
+        self.stall_time = 0.
+        self.full = 0
+
+        self._index = 0
+        self._epoch = 0
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._fill()
+
+    def _fill(self):
+        while len(self._pending) < self.depth:
+            if not self.is_sequence:
+                self._pending.append(self._executor.submit(next, self.data))
+                continue
+
+            if self._index >= len(self.data):
+                if self._pending or self.epochs is not None and self._epoch + 1 >= self.epochs:
+                    # The epoch's batches are still being consumed, or it was the last one.
+                    return
+                self.data.on_epoch_end()
+                self._index = 0
+                self._epoch += 1
+
+            self._pending.append(self._executor.submit(self.data.__getitem__, self._index))
+            self._index += 1
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._executor is None:
+            raise RuntimeError('next called on a closed prefetcher')
+        if not self._pending:
+            raise StopIteration
+
+        if len(self._pending) == self.depth and all(f.done() for f in self._pending):
+            self.full += 1
+
+        f = self._pending.popleft()
+        if not f.done():
+            self.stalls += 1
+            started = time.time()
+            wait([f])
+            self.stall_time += time.time() - started
+
+        self._fill()
+        self.batches += 1
+        return f.result()
+
+    next = __next__
+
+    def close(self):
+        """Stop loading batches, waiting for the ones being loaded."""
+        if self._executor is not None:
+            for f in self._pending:
+                f.cancel()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._pending.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __getattr__(self, item):
+        if item == 'data':
+            raise AttributeError(item)
+        return getattr(self.data, item)
+
+
 class PaintingEnhancer:
     def __init__(self, augmentations=('color', 'brightness', 'contrast'),
                  variability=0.25):
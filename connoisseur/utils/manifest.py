@@ -0,0 +1,82 @@
+"""Extraction Manifests.
+
+Record of the paintings whose patches were completely extracted, used to
+resume interrupted extractions.
+
+Author: Lucas David -- <lucasolivdavid@gmail.com>
+Licence: MIT License 2016 (c)
+
+"""
+
+import json
+import os
+
+# Hidden, so it is not taken for a label folder by directory listings.
+MANIFEST_FILE = '.manifest.jsonl'
+
+
+class ExtractionManifest:
+    """Extraction Manifest.
+
+    Append-only file with one JSON entry per completed painting, holding
+    its label, the parameters used, the number of patches extracted and,
+    for sharded outputs, the index rows of its patches (see
+    `connoisseur.utils.shards.save_index`).
+
+    Entries are written with a single `write` call to a file opened in
+    append mode, so multiple processes can record into the same manifest.
+    Lines left incomplete by interrupted runs are ignored when loading.
+
+    Parameters
+    ----------
+    directory: str, the phase directory in which patches are extracted.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.file_name = os.path.join(directory, MANIFEST_FILE)
+
+        legacy = os.path.join(directory, MANIFEST_FILE.lstrip('.'))
+        if os.path.exists(legacy) and not os.path.exists(self.file_name):
+            os.replace(legacy, self.file_name)
+
+    @staticmethod
+    def normalize(params):
+        """Convert `params` into what is read back from the manifest."""
+        return json.loads(json.dumps(params))
+
+    def load(self):
+        """Load the entries recorded.
+
+        :return: dict {(label, painting): entry}. If a painting was recorded
+            more than once, its last entry is kept.
+        """
+        entries = {}
+
+        if not os.path.exists(self.file_name):
+            return entries
+
+        with open(self.file_name) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                entries[(entry['label'], entry['painting'])] = entry
+        return entries
+
+    def record(self, painting, label, params, patches, rows=()):
+        """Record a painting as completed.
+
+        :param params: dict, the parameters with which patches were extracted.
+        :param patches: int, the number of patches extracted.
+        :param rows: list, the index rows of the patches, if sharded.
+        """
+        line = json.dumps(dict(painting=painting, label=label, params=params,
+                               patches=patches, rows=list(rows))) + '\n'
+
+        fd = os.open(self.file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
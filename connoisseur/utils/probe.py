@@ -0,0 +1,88 @@
+"""Image Probing.
+
+Size, mode and format of images, read from their headers alone. No pixel
+is ever decoded.
+
+Author: Lucas David -- <lucasolivdavid@gmail.com>
+Licence: MIT License 2016 (c)
+
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from .records import structured_array
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm', '.tif', '.tiff')
+
+
+def list_images(directory):
+    """List the images in `directory` and in up to two levels of folders.
+
+    Deeper folders (e.g. extracted patches) and hidden ones are ignored.
+
+    :return: list of (path, phase, label), where `path` is relative to
+        `directory` and `phase` and `label` are the folders containing the
+        image (i.e. `{phase}/{label}/{image}`), if any.
+    """
+    images = []
+    for root, dirs, files in os.walk(directory):
+        folders = os.path.relpath(root, directory).split(os.sep)
+        folders = [] if folders == ['.'] else folders
+        dirs[:] = [] if len(folders) == 2 else [d for d in dirs if not d.startswith('.')]
+        label = folders[-1] if folders else ''
+        phase = folders[-2] if len(folders) > 1 else ''
+
+        images += [('/'.join(folders + [f]), phase, label)
+                   for f in sorted(files) if f.lower().endswith(IMAGE_EXTENSIONS)]
+    return sorted(images)
+
+
+def probe_image(file_name):
+    """Read the header of an image.
+
+    :param file_name: str or file object.
+    :return: (width, height, mode, format).
+    """
+    with Image.open(file_name) as image:
+        return image.size + (image.mode, image.format)
+
+
+def _probe_or_none(file_name):
+    try:
+        return probe_image(file_name)
+    except (OSError, SyntaxError):
+        # PIL raises SyntaxError on some broken headers.
+        return None
+
+
+def probe_images(directory, n_jobs=8):
+    """Probe the images in `directory`. See `list_images`.
+
+    Headers are read by `n_jobs` threads, as probing is bound by file
+    access rather than computation.
+
+    :return: structured array with the fields `path`, `phase`, `label`,
+        `width`, `height`, `mode` and `format`, sorted by `path`. Images
+        that cannot be read have zero width and height and no format.
+    """
+    images = list_images(directory)
+    files = [os.path.join(directory, path) for path, _, _ in images]
+
+    if n_jobs == 1:
+        probed = list(map(_probe_or_none, files))
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            probed = list(executor.map(_probe_or_none, files))
+
+    failed = [path for (path, _, _), p in zip(images, probed) if p is None]
+    if failed:
+        print('could not read %i images:' % len(failed), failed[:10], '...' if len(failed) > 10 else '')
+
+    rows = [i + (p or (0, 0, '', '')) for i, p in zip(images, probed)]
+    return structured_array(rows, [('path', str), ('phase', str), ('label', str),
+                                   ('width', np.int32), ('height', np.int32),
+                                   ('mode', str), ('format', str)])
@@ -0,0 +1,149 @@
+"""Ragged Arrays.
+
+Author: Lucas David -- <lucasolivdavid@gmail.com>
+Licence: MIT License 2016 (c)
+
+"""
+
+import numpy as np
+
+
+class RaggedArray:
+    """Ragged Array.
+
+    Sequence of arrays with different lengths (e.g. the patches of paintings
+    of different sizes), stored in CSR-style: the rows are concatenated into
+    a single `data` array, and row `i` spans `data[offsets[i]:offsets[i + 1]]`.
+    Rows are retrieved as views and reductions over the rows are vectorized.
+
+    Parameters
+    ----------
+    data: array-like, shaped as (n_samples, ...), the concatenated rows.
+    offsets: array-like, shaped as (n_rows + 1,), the starting position of
+        each row in `data`, followed by the length of `data`.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = np.asarray(data)
+        self.offsets = np.asarray(offsets, dtype=int)
+
+        if self.offsets[0] != 0 or self.offsets[-1] != len(self.data):
+            raise ValueError('offsets must start at 0 and end at len(data) (%i). '
+                             'Got [%i, ..., %i] instead.'
+                             % (len(self.data), self.offsets[0], self.offsets[-1]))
+
+    @classmethod
+    def from_lengths(cls, data, lengths):
+        return cls(data, np.concatenate(([0], np.cumsum(lengths))))
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        """Retrieve rows.
+
+        :param idx: int, slice, array of indices or boolean mask.
+        :return: the row, as a view of `data`, if `idx` is an int.
+            A `RaggedArray` with the selected rows otherwise, which shares
+            `data` with this one if `idx` is a contiguous slice.
+        """
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            if not 0 <= idx < len(self):
+                raise IndexError('index %i is out of bounds for %i rows' % (idx, len(self)))
+            return self.data[self.offsets[idx]:self.offsets[idx + 1]]
+
+        if isinstance(idx, slice) and idx.step in (None, 1):
+            start, stop, _ = idx.indices(len(self))
+            stop = max(start, stop)
+            return RaggedArray(self.data[self.offsets[start]:self.offsets[stop]],
+                               self.offsets[start:stop + 1] - self.offsets[start])
+
+        rows = np.arange(len(self))[idx]
+        lengths = self.lengths[rows]
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        samples = np.arange(offsets[-1]) + np.repeat(self.offsets[rows] - offsets[:-1], lengths)
+        return RaggedArray(self.data[samples], offsets)
+
+    def __iter__(self):
+        for start, end in zip(self.offsets[:-1], self.offsets[1:]):
+            yield self.data[start:end]
+
+    def __repr__(self):
+        return 'RaggedArray(rows=%i, samples=%i, dtype=%s)' % (len(self), len(self.data), self.dtype)
+
+    def map(self, fn):
+        """Apply `fn` to all samples at once, keeping the same rows."""
+        return RaggedArray(fn(self.data), self.offsets)
+
+    def row_ids(self):
+        """The row of each sample in `data`."""
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def pad(self, fill_value=0, max_length=None):
+        """Stack the rows into a dense array, padding the shorter ones.
+
+        :param fill_value: value assigned to the padded positions.
+        :param max_length: int, the length of the padded rows. Longer rows
+            are truncated. The length of the longest row is used if None.
+        :return: (padded, mask), where `padded` is shaped as
+            (n_rows, max_length, ...) and `mask` is a boolean array shaped
+            as (n_rows, max_length), true where values came from `data`.
+        """
+        lengths = self.lengths
+        if max_length is None:
+            max_length = lengths.max() if len(lengths) else 0
+
+        rows = self.row_ids()
+        columns = np.arange(len(self.data)) - np.repeat(self.offsets[:-1], lengths)
+        s = columns < max_length
+
+        padded = np.full((len(self), max_length) + self.data.shape[1:], fill_value, dtype=self.dtype)
+        padded[rows[s], columns[s]] = self.data[s]
+
+        mask = np.zeros((len(self), max_length), dtype=bool)
+        mask[rows[s], columns[s]] = True
+        return padded, mask
+
+    def _reduceat(self, ufunc, empty_value):
+        lengths = self.lengths
+        shape = (len(self),) + self.data.shape[1:]
+
+        if not len(self.data):
+            return np.full(shape, empty_value)
+
+        # `reduceat` does not handle empty rows: their entries are replaced.
+        starts = np.minimum(self.offsets[:-1], len(self.data) - 1)
+        r = ufunc.reduceat(self.data, starts, axis=0)
+
+        empty = lengths == 0
+        if empty.any():
+            r = r.astype(np.result_type(r, empty_value))
+            r[empty] = empty_value
+        return r
+
+    def count(self):
+        return self.lengths
+
+    def sum(self):
+        return self._reduceat(np.add, 0)
+
+    def mean(self):
+        lengths = self.lengths.reshape((-1,) + (1,) * (self.data.ndim - 1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum() / lengths
+
+    def max(self):
+        return self._reduceat(np.maximum, np.nan)
+
+    def min(self):
+        return self._reduceat(np.minimum, np.nan)
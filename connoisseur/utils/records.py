@@ -0,0 +1,26 @@
+"""Structured Arrays.
+
+Author: Lucas David -- <lucasolivdavid@gmail.com>
+Licence: MIT License 2016 (c)
+
+"""
+
+import numpy as np
+
+
+def structured_array(rows, fields):
+    """Build a structured array from a list of rows.
+
+    :param rows: list of tuples, holding one value for each field.
+    :param fields: list of (name, dtype). Fields typed `str` are sized
+        after their longest value.
+    :return: structured array shaped as (len(rows),).
+    """
+    columns = list(zip(*rows)) or [[]] * len(fields)
+    dtype = [(name, np.asarray(column, dtype=str).dtype if t is str else t)
+             for (name, t), column in zip(fields, columns)]
+
+    array = np.empty(len(rows), dtype=dtype)
+    for (name, _), column in zip(fields, columns):
+        array[name] = column
+    return array
@@ -0,0 +1,169 @@
+"""Patch Shards.
+
+Patches packed into a few large files, instead of one small file each.
+A sharded phase directory contains the shard files, which hold the encoded
+patches back-to-back, and an `index.npy` file describing each patch.
+
+Author: Lucas David -- <lucasolivdavid@gmail.com>
+Licence: MIT License 2016 (c)
+
+"""
+
+import io
+import mmap
+import os
+
+import numpy as np
+from PIL import Image
+
+from .records import structured_array
+
+INDEX_FILE = 'index.npy'
+
+
+def is_sharded(directory):
+    """Check whether `directory` contains sharded patches."""
+    return os.path.exists(os.path.join(directory, INDEX_FILE))
+
+
+def save_index(directory, rows):
+    """Save the index of the patches written by one or more `PatchShardWriter`s.
+
+    :param directory: str, the sharded phase directory.
+    :param rows: list of (painting, patch, label, shard, offset, size) tuples.
+    """
+    rows = sorted(rows, key=lambda r: (r[2], r[0], r[1]))
+    index = structured_array(rows, [('painting', str), ('patch', np.int32), ('label', str),
+                                    ('shard', str), ('offset', np.int64), ('size', np.int64)])
+    np.save(os.path.join(directory, INDEX_FILE), index)
+
+
+class PatchShardWriter:
+    """Patch Shard Writer.
+
+    Appends encoded patches to shard files, starting a new shard whenever
+    the current one exceeds `max_shard_size` bytes.
+
+    Parameters
+    ----------
+    directory: str, the sharded phase directory.
+    prefix: str, prefix of the shard files, which must be unique among the
+        writers of a same directory.
+    max_shard_size: int, the size (in bytes) from which new shards are
+        started.
+    image_format: str, the format in which patches are encoded.
+    """
+
+    def __init__(self, directory, prefix='shard', max_shard_size=1024 ** 3,
+                 image_format='JPEG'):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_shard_size = max_shard_size
+        self.image_format = image_format
+
+        self.rows = []
+        self._file = None
+        self._shard = None
+        self._n_shards = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _next_shard(self):
+        self.close()
+        self._shard = '%s-%05i.bin' % (self.prefix, self._n_shards)
+        self._file = open(os.path.join(self.directory, self._shard), 'wb')
+        self._n_shards += 1
+
+    def write(self, painting, patch_id, label, patch):
+        """Append a patch to the current shard.
+
+        :param painting: str, the name of the painting.
+        :param patch_id: int, the id of the patch within the painting.
+        :param label: str, the label of the painting.
+        :param patch: PIL Image, the patch.
+        """
+        if self._file is None or self._file.tell() >= self.max_shard_size:
+            self._next_shard()
+
+        buffer = io.BytesIO()
+        patch.save(buffer, format=self.image_format)
+        encoded = buffer.getvalue()
+
+        self.rows.append((painting, patch_id, label, self._shard, self._file.tell(), len(encoded)))
+        self._file.write(encoded)
+
+    def flush(self):
+        """Make sure the patches written so far are in the shard file."""
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class PatchShards:
+    """Reader of Sharded Patches.
+
+    Patches are named after the `{label}/{painting}-{patch}.jpg` files that
+    would have been otherwise extracted, and sorted by these names.
+    Shards are memory-mapped on demand.
+
+    Parameters
+    ----------
+    directory: str, the sharded phase directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = np.load(os.path.join(directory, INDEX_FILE))
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def labels(self):
+        return self.index['label']
+
+    @property
+    def names(self):
+        return np.asarray(['%s/%s-%i.jpg' % (r['label'], r['painting'], r['patch'])
+                           for r in self.index])
+
+    def _map(self, shard):
+        if shard not in self._maps:
+            with open(os.path.join(self.directory, shard), 'rb') as f:
+                self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[shard]
+
+    def read(self, i):
+        """Read the encoded bytes of the `i`-th patch."""
+        r = self.index[i]
+        offset = int(r['offset'])
+        return self._map(str(r['shard']))[offset:offset + int(r['size'])]
+
+    def load_img(self, i, target_size=None):
+        """Decode the `i`-th patch, similarly to `keras.preprocessing.image.load_img`.
+
+        :param target_size: (height, width), the size of the image returned.
+        :return: PIL Image, in RGB mode.
+        """
+        img = Image.open(io.BytesIO(self.read(i)))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        if target_size is not None and img.size != (target_size[1], target_size[0]):
+            img = img.resize((target_size[1], target_size[0]), Image.NEAREST)
+        return img
+
+    def close(self):
+        for m in self._maps.values():
+            m.close()
+        self._maps = {}
+
+    def __getstate__(self):
+        # Memory-maps cannot be pickled, so workers re-open the shards.
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
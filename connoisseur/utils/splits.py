@@ -0,0 +1,96 @@
+"""Split Manifests.
+
+Assignment of training paintings to other phases (e.g. validation),
+without moving any files.
+
+Author: Lucas David -- <lucasolivdavid@gmail.com>
+Licence: MIT License 2016 (c)
+
+"""
+
+import json
+import os
+
+import numpy as np
+
+SPLIT_FILE = 'split.json'
+
+
+def split_file_name(data_dir):
+    return os.path.join(data_dir, SPLIT_FILE)
+
+
+def phase_sources(data_dir, split_file=None, phases=('train', 'valid')):
+    """Where the patches of each phase are read from.
+
+    With a split manifest, all phases are read from the `train` patches,
+    each one restricted to its own paintings.
+
+    :param data_dir: str, the directory containing the phases' patches.
+    :param split_file: str, the split manifest's file name, if any.
+    :return: list of (directory, kwargs) for each phase, where `kwargs`
+        are the `split` and `subset` to pass to the Sequence reading it.
+    """
+    if split_file:
+        return [(os.path.join(data_dir, 'train'), {'split': split_file, 'subset': p}) for p in phases]
+    return [(os.path.join(data_dir, p), {}) for p in phases]
+
+
+def painting_of(name, patches=False):
+    """The `{label}/{painting}` a file belongs to.
+
+    :param name: str, a `{label}/{painting}.{ext}` file name or, if
+        `patches`, a `{label}/{painting}-{id}.jpg` patch name.
+    """
+    name = os.path.splitext(name)[0]
+    return name.rpartition('-')[0] if patches else name
+
+
+class SplitManifest:
+    """Split Manifest.
+
+    Paintings physically in the `train` folder which belong to other
+    phases, identified by `{label}/{painting}` (without extension). The
+    `train` phase is formed by the paintings not assigned to any other.
+
+    Parameters
+    ----------
+    phases: dict {phase: paintings}, the paintings assigned to each phase.
+    """
+
+    def __init__(self, phases=None):
+        self.phases = {phase: set(paintings) for phase, paintings in (phases or {}).items()}
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name) as f:
+            return cls(json.load(f))
+
+    @classmethod
+    def load_if_exists(cls, file_name):
+        return cls.load(file_name) if os.path.exists(file_name) else None
+
+    def save(self, file_name):
+        with open(file_name, 'w') as f:
+            json.dump({phase: sorted(paintings) for phase, paintings in self.phases.items()}, f, indent=1)
+
+    def __contains__(self, phase):
+        return phase == 'train' or phase in self.phases
+
+    def mask(self, phase, names, patches=False):
+        """Which of the files `names`, within the `train` folder, belong to `phase`.
+
+        :param names: list of file names. See `painting_of`.
+        :return: boolean array.
+        """
+        if phase not in self:
+            raise ValueError('unknown phase %s. Phases are: %s'
+                             % (phase, ['train'] + sorted(self.phases)))
+
+        paintings = [painting_of(n, patches) for n in names]
+
+        if phase == 'train':
+            others = set().union(*self.phases.values())
+            return np.asarray([p not in others for p in paintings], dtype=bool)
+
+        return np.asarray([p in self.phases[phase] for p in paintings], dtype=bool)
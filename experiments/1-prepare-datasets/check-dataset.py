@@ -1,33 +1,30 @@
-import os
-
 import numpy as np
-from keras.preprocessing.image import load_img
 from sacred import Experiment
 
+from connoisseur.utils.probe import probe_images
+
 ex = Experiment('check-dataset')
 
 
 @ex.config
 def my_config():
     data_dir = '/datasets/vangogh/vgdb_2016/test/'
+    n_jobs = 8
 
 
 @ex.automain
-def main(data_dir):
+def main(data_dir, n_jobs):
     print('loading data...')
-    labels = os.listdir(data_dir)
-
-    samples = [list(map(lambda p: {
-        'path': data_dir + c + '/' + p,
-        'label': c,
-        'sizes': load_img(data_dir + c + '/' + p).size
-    }, os.listdir(data_dir + c))) for c in labels]
-    samples = np.concatenate(samples)
+    samples = probe_images(data_dir, n_jobs=n_jobs)
 
     print('number of samples:', len(samples))
-    print(samples[:10], '...')
+    print(samples[['path', 'label', 'width', 'height']][:10], '...')
+
+    for field in ('format', 'mode'):
+        values, counts = np.unique(samples[field], return_counts=True)
+        print('%ss:' % field, dict(zip(values, counts)))
 
-    sizes = np.asarray([s['sizes'] for s in samples])
+    sizes = np.stack((samples['width'], samples['height']), axis=1)
 
     print('min sizes:', sizes.min(axis=0))
     print('avg sizes:', sizes.mean(axis=0))
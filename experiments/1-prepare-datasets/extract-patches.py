@@ -26,21 +26,27 @@ def config():
     data_dir = '/datasets/vangogh-test-recaptures/recaptures-vangogh-museum/original'
     saving_directory = '/datasets/vangogh-test-recaptures/recaptures-vangogh-museum/original/patches/random_224'
     valid_size = 0
+    split_method = 'move'
     train_n_patches = 50
     valid_n_patches = 50
     test_n_patches = 50
     downloading = False
     extracting = False
     preparing = False
-    pool_size = 4
+    pool_size = 1
     patches_saving_mode = 'all'
+    gradient_backend = 'numpy'
+    patches_output = 'files'
+    max_pixels = 2 ** 25
+    from_archive = False
     device = '/cpu:0'
 
 
 @ex.automain
 def run(dataset_name, dataset_seed, classes, image_shape, data_dir, saving_directory,
         downloading, extracting, preparing, train_n_patches, valid_n_patches, test_n_patches,
-        patches_saving_mode, valid_size, n_jobs, pool_size, device):
+        patches_saving_mode, valid_size, split_method, n_jobs, pool_size, gradient_backend, patches_output,
+        max_pixels, from_archive, device):
     from PIL import Image, ImageFile
     import tensorflow as tf
     from connoisseur import datasets
@@ -64,8 +70,10 @@ def run(dataset_name, dataset_seed, classes, image_shape, data_dir, saving_direc
     if preparing:
         dataset.prepare()
     if valid_size > 0:
-        dataset.split(fraction=valid_size, phase='valid')
+        dataset.split(fraction=valid_size, phase='valid', method=split_method)
     with tf.device(device):
-        dataset.save_patches_to_disk(directory=saving_directory, mode=patches_saving_mode, pool_size=pool_size)
+        dataset.save_patches_to_disk(directory=saving_directory, mode=patches_saving_mode, pool_size=pool_size,
+                                     backend=gradient_backend, output=patches_output,
+                                     max_pixels=max_pixels, from_archive=from_archive)
 
     print('done')
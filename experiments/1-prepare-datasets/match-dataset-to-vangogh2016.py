@@ -3,12 +3,15 @@ import shutil
 
 import matplotlib
 import numpy as np
-from keras.preprocessing.image import load_img
+from PIL import Image
 
 matplotlib.use('agg')
 
 from sacred import Experiment
 
+from connoisseur.utils.image import load_img
+from connoisseur.utils.probe import probe_images
+
 ex = Experiment('convert-cross-dataset')
 
 
@@ -18,28 +21,28 @@ def my_config():
     originals_dir = '/datasets/vangogh/vgdb_2016/'
     output_dir = '/datasets/vangogh-test-recaptures/recaptures-google-vangogh2016/resized/vgdb_2016/test/'
     resize = True
+    n_jobs = 8
 
 
 @ex.automain
-def main(data_dir, originals_dir, output_dir, resize):
+def main(data_dir, originals_dir, output_dir, resize, n_jobs):
     print('loading data...')
     if os.path.exists(output_dir): shutil.rmtree(output_dir)
     os.makedirs(output_dir)
 
-    labels = os.listdir(os.path.join(originals_dir, 'train'))
-    all_sizes = {
-        phase: list(map(lambda p: {
-            'name': p,
-            'path': os.path.join(originals_dir, phase, c, p),
-            'label': c,
-            'sizes': load_img(os.path.join(originals_dir, phase, c, p)).size
-        }, os.listdir(os.path.join(originals_dir, phase, c)))) for c in labels
-        for phase in ['train', 'valid', 'test']
-        if os.path.exists(originals_dir + phase)
-    }
-
-    test_painting_sizes = {os.path.splitext(s['name'])[0]: s['sizes'] for s in all_sizes['test']}
-    train_painting_sizes = {os.path.splitext(s['name'])[0]: s['sizes'] for s in all_sizes['train']}
+    originals = probe_images(originals_dir, n_jobs=n_jobs)
+    recaptures = probe_images(data_dir, n_jobs=n_jobs)
+    recapture_sizes = {p: (w, h) for p, w, h in zip(recaptures['path'],
+                                                    recaptures['width'],
+                                                    recaptures['height'])}
+
+    def painting_sizes(phase):
+        s = originals[originals['phase'] == phase]
+        return {os.path.splitext(os.path.basename(p))[0]: (w, h)
+                for p, w, h in zip(s['path'], s['width'], s['height'])}
+
+    test_painting_sizes = painting_sizes('test')
+    train_painting_sizes = painting_sizes('train')
 
     sizes_ = np.asarray(list(train_painting_sizes.values()))
     horizontals = np.argmax(sizes_, axis=1) == 0
@@ -62,8 +65,7 @@ def main(data_dir, originals_dir, output_dir, resize):
             original_name = '-'.join(s.split('-')[:-1])
 
             if resize:
-                image = load_img(data_dir + c + '/' + s)
-                size = np.array(image.size)
+                size = np.array(recapture_sizes[c + '/' + s])
                 is_horizontal = size[0] > size[1]
                 size_ix = 0 if is_horizontal else 1
 
@@ -76,9 +78,12 @@ def main(data_dir, originals_dir, output_dir, resize):
                 if abs(size - size_)[size_ix] > std_[size_ix]:
                     # Only reshape if difference is above std.
                     ratio = size_[size_ix] / size[size_ix]
-                    image = image.resize((int(size[0] * ratio), int(size[1] * ratio)))
+                    image = load_img(data_dir + c + '/' + s,
+                                     target_size=(int(size[1] * ratio), int(size[0] * ratio)),
+                                     resample=Image.LANCZOS)
                     print(s, size, '-->', image.size)
                 else:
+                    image = load_img(data_dir + c + '/' + s)
                     print(s, size)
 
                 image.save(output_dir + c + '/' + s)
@@ -1,9 +1,10 @@
 import os
 
-from keras.preprocessing.image import load_img, img_to_array
-from pandas.io.json import json_normalize
+import pandas as pd
 from sacred import Experiment
 
+from connoisseur.utils.catalog import load_catalog
+
 ex = Experiment('recaptures-physical')
 
 
@@ -18,28 +19,23 @@ def config():
               'nvg_10582548-2', 'vg_9103139-0', 'vg_9103139-1', 'vg_9387502-3',
               'vg_9414279-1', 'vg_9463012-0', 'vg_9386980-1', 'nvg_9780042-2',
               'vg_9506505-1']
+    n_jobs = 1
 
 
 @ex.automain
-def main(originals_dataset, recaptures_dataset, metrics, misses):
+def main(originals_dataset, recaptures_dataset, metrics, misses, n_jobs):
     print('originals:', originals_dataset)
 
-    originals, recaptures = [], []
-    for d, o in ((originals_dataset, originals), (recaptures_dataset, recaptures)):
-        for c in os.listdir(d):
-            for f in os.listdir(os.path.join(d, c)):
-                i = load_img(os.path.join(d, c, f))
-                a = img_to_array(i)
-                o += [{'name': os.path.splitext(f)[0],
-                       'width': i.size[0],
-                       'height': i.size[1],
-                       **dict(zip(('r', 'g', 'b'),
-                                  a.mean(axis=(0, 1))))}]
-
-    originals = json_normalize(originals)
-    originals.set_index('name', inplace=True)
-    recaptures = json_normalize(recaptures)
-    recaptures.set_index('name', inplace=True)
+    def physical_metrics(d):
+        catalog = load_catalog(d, n_jobs=n_jobs)
+        frame = pd.DataFrame({m: catalog[m] for m in ('width', 'height', 'r', 'g', 'b')},
+                             index=[os.path.splitext(os.path.basename(p))[0]
+                                    for p in catalog['path']])
+        frame.index.name = 'name'
+        return frame
+
+    originals = physical_metrics(originals_dataset)
+    recaptures = physical_metrics(recaptures_dataset)
     recaptures['original'] = [i.split('-')[0] for i in recaptures.index]
 
     print('average values:')
@@ -3,12 +3,14 @@ import shutil
 
 import matplotlib
 import numpy as np
-from keras.preprocessing.image import load_img
+from PIL import Image
 
 matplotlib.use('agg')
 
 from sacred import Experiment
 
+from connoisseur.utils.image import load_img
+
 ex = Experiment('convert-cross-dataset')
 
 
@@ -32,9 +34,11 @@ def main(data_dir, output_dir, max_sizes):
             if s.startswith('original'):
                 continue
 
-            image = load_img(data_dir + c + '/' + s)
-            size = np.array(image.size)
+            with Image.open(data_dir + c + '/' + s) as image:
+                size = np.array(image.size)
             ratio = max_sizes[0] / size[0]
-            image = image.resize((int(size[0] * ratio), int(size[1] * ratio)))
+            image = load_img(data_dir + c + '/' + s,
+                             target_size=(int(size[1] * ratio), int(size[0] * ratio)),
+                             resample=Image.LANCZOS)
             print(s, size, '-->', image.size)
             image.save(output_dir + c + '/' + s)
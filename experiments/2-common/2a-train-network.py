@@ -24,6 +24,8 @@ from sacred.utils import apply_backspaces_and_linefeeds
 
 from connoisseur.models import build_model
 from connoisseur.utils import get_preprocess_fn
+from connoisseur.utils.image import flow_from_patches, list_label_folders
+from connoisseur.utils.splits import phase_sources
 
 ex = Experiment('train-network')
 
@@ -71,6 +73,8 @@ def config():
     first_reset_layer = None
     class_weight = 'balanced'
     class_mode = 'categorical'
+    cache_dir = None
+    split_file = None
 
 
 def get_class_weights(y):
@@ -81,7 +85,7 @@ def get_class_weights(y):
 
 @ex.automain
 def run(_run, image_shape, data_dir, train_shuffle, dataset_train_seed, valid_shuffle, dataset_valid_seed,
-        classes, class_mode, class_weight,
+        classes, class_mode, class_weight, cache_dir, split_file,
         architecture, weights, batch_size, last_base_layer, use_gram_matrix, pooling, dense_layers,
         device, opt_params, dropout_p, resuming_from_ckpt_file, steps_per_epoch,
         epochs, validation_steps, workers, use_multiprocessing, initial_epoch, early_stop_patience,
@@ -101,17 +105,19 @@ def run(_run, image_shape, data_dir, train_shuffle, dataset_train_seed, valid_sh
         preprocessing_function=get_preprocess_fn(architecture))
 
     if isinstance(classes, int):
-        classes = sorted(os.listdir(os.path.join(data_dir, 'train')))[:classes]
+        classes = list_label_folders(os.path.join(data_dir, 'train'))[:classes]
 
-    train_data = g.flow_from_directory(
-        os.path.join(data_dir, 'train'),
+    (train_dir, train_split), (valid_dir, valid_split) = phase_sources(data_dir, split_file)
+
+    train_data = flow_from_patches(
+        g, train_dir, cache_dir=cache_dir,
         target_size=image_shape[:2], classes=classes, class_mode=class_mode,
-        batch_size=batch_size, shuffle=train_shuffle, seed=dataset_train_seed)
+        batch_size=batch_size, shuffle=train_shuffle, seed=dataset_train_seed, **train_split)
 
-    valid_data = g.flow_from_directory(
-        os.path.join(data_dir, 'valid'),
+    valid_data = flow_from_patches(
+        g, valid_dir, cache_dir=cache_dir,
         target_size=image_shape[:2], classes=classes, class_mode=class_mode,
-        batch_size=batch_size, shuffle=valid_shuffle, seed=dataset_valid_seed)
+        batch_size=batch_size, shuffle=valid_shuffle, seed=dataset_valid_seed, **valid_split)
 
     if class_weight == 'balanced':
         class_weight = get_class_weights(train_data.classes)
@@ -21,6 +21,7 @@ from connoisseur import get_preprocess_fn
 from connoisseur.datasets.painter_by_numbers import load_multiple_outputs
 from connoisseur.models import build_model
 from connoisseur.utils.image import MultipleOutputsDirectorySequence
+from connoisseur.utils.splits import phase_sources
 
 ex = Experiment('train-network-multiple-predictions')
 
@@ -69,6 +70,7 @@ def config():
         {'n': 'date', 'u': 1, 'a': 'linear', 'l': 'mse', 'm': 'mae', 'w': .1}
     ]
     balanced = True
+    split_file = None
 
 
 @ex.automain
@@ -76,7 +78,7 @@ def run(_run, data_dir, subdirectories, train_shuffle, valid_shuffle, image_shap
         architecture, weights, last_base_layer, use_gram_matrix, pooling, dropout_p, device,
         epochs, steps_per_epoch, validation_steps, initial_epoch, opt_params, resuming_from, ckpt_file,
         workers, use_multiprocessing, early_stop_patience, first_trainable_layer,
-        outputs_meta, balanced):
+        outputs_meta, balanced, split_file):
     try:
         report_dir = _run.observers[0].dir
     except IndexError:
@@ -95,14 +97,15 @@ def run(_run, data_dir, subdirectories, train_shuffle, valid_shuffle, image_shap
         fill_mode='reflect',
         preprocessing_function=get_preprocess_fn(architecture))
 
-    train_data = MultipleOutputsDirectorySequence(os.path.join(data_dir, 'train'), outputs, name_map, g,
+    (train_dir, train_split), (valid_dir, valid_split) = phase_sources(data_dir, split_file)
+    train_data = MultipleOutputsDirectorySequence(train_dir, outputs, name_map, g,
                                                   batch_size=batch_size, target_size=image_shape[:2],
                                                   subdirectories=subdirectories,
-                                                  shuffle=train_shuffle)
-    valid_data = MultipleOutputsDirectorySequence(os.path.join(data_dir, 'valid'), outputs, name_map, g,
+                                                  shuffle=train_shuffle, **train_split)
+    valid_data = MultipleOutputsDirectorySequence(valid_dir, outputs, name_map, g,
                                                   batch_size=batch_size, target_size=image_shape[:2],
                                                   subdirectories=subdirectories,
-                                                  shuffle=valid_shuffle)
+                                                  shuffle=valid_shuffle, **valid_split)
 
     if balanced:
         class_weight = {}
@@ -110,10 +113,10 @@ def run(_run, data_dir, subdirectories, train_shuffle, valid_shuffle, image_shap
         for o in outputs_meta:
             if o['a'] in ('sigmoid', 'softmax'):
                 name = o['n']
-                y = outputs[name]
-                y = np.argmax(y, axis=-1)
-
-            class_weight[name] = compute_class_weight('balanced', np.unique(y), y)
+                # The integer codes, not the one-hot matrix, which is only
+                # expanded per batch.
+                y = outputs[name].codes
+                class_weight[name] = compute_class_weight('balanced', np.unique(y), y)
     else:
         class_weight = None
 
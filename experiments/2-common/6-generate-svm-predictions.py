@@ -20,10 +20,11 @@ from sklearn.externals import joblib
 
 from connoisseur.datasets import group_by_paintings
 from connoisseur.fusion import Fusion, strategies
+from connoisseur.utils import RaggedArray
 
 matplotlib.use('agg')
 
-from connoisseur.datasets import load_pickle_data
+from connoisseur.datasets import iter_pickle_data
 
 tf.logging.set_verbosity(tf.logging.DEBUG)
 
@@ -41,12 +42,10 @@ def config():
     classes = None
     layer = 'global_average_pooling2d_1'
     max_patches = None
+    block_size = 10000
 
 
-def evaluate(model, x, y, names,
-             group_patches=False,
-             group_recaptures=False,
-             max_patches=None):
+def predict(model, x):
     try:
         probabilities = model.predict_proba(x)
         labels = np.argmax(probabilities, axis=-1)
@@ -58,6 +57,36 @@ def evaluate(model, x, y, names,
         hyperplane_distance = model.decision_function(x)
         multi_class = len(model.classes_) > 2
 
+    return probabilities, labels, hyperplane_distance, multi_class
+
+
+def predict_blocks(model, blocks, layer):
+    """Predict a stream of (data, target, names) blocks, one at a time.
+
+    :return: the predictions, or None if the stream is empty.
+    """
+    outputs = []
+
+    for x, y, names in blocks:
+        x = x[layer]
+        x = x.reshape(x.shape[0], -1)
+        probabilities, labels, hyperplane_distance, multi_class = predict(model, x)
+        outputs.append((probabilities, labels, hyperplane_distance, y, names))
+
+    if not outputs:
+        # All blocks were filtered out (e.g. by `classes`).
+        return None
+
+    probabilities, labels, hyperplane_distance, y, names = (
+        None if o[0] is None else np.concatenate(o)
+        for o in zip(*outputs))
+    return probabilities, labels, hyperplane_distance, multi_class, y, names
+
+
+def evaluate(probabilities, labels, hyperplane_distance, multi_class, y, names,
+             group_patches=False,
+             group_recaptures=False,
+             max_patches=None):
     p = probabilities if probabilities is not None else hyperplane_distance
 
     score = metrics.accuracy_score(y, labels)
@@ -80,7 +109,7 @@ def evaluate(model, x, y, names,
         labels, p, y, names = group_by_paintings(labels, p, y, names=names, max_patches=max_patches)
         y = np.asarray([_y[0] for _y in y])
 
-        patches = p.shape[1] if len(p.shape) > 1 else 'all'
+        patches = 'all' if isinstance(p, RaggedArray) else p.shape[1]
 
         for strategy_tag in ('sum', 'mean', 'farthest', 'most_frequent'):
             strategy = getattr(strategies, strategy_tag)
@@ -127,26 +156,27 @@ def evaluate(model, x, y, names,
 @ex.automain
 def run(_run, data_dir, phases, classes, layer, ckpt,
         results_file_name, group_patches, group_recaptures,
-        max_patches):
+        max_patches, block_size):
     report_dir = _run.observers[0].dir
 
     print('loading model...', end=' ')
     model = joblib.load(ckpt)
     print('done.')
 
-    print('loading data...', end=' ')
-    data = load_pickle_data(data_dir=data_dir, phases=phases, chunks=(0, 1), classes=classes, layers=[layer])
-    print('done.')
-
     results = []
 
     for p in phases:
         print('\n# %s evaluation' % p)
-        x, y, names = data[p]
-        x = x[layer]
-        x = x.reshape(x.shape[0], -1)
+        blocks = iter_pickle_data(data_dir=data_dir, phase=p, chunks=(0, 1), classes=classes,
+                                  layers=[layer], block_size=block_size)
+
+        predictions = predict_blocks(model, blocks, layer)
+
+        if predictions is None:
+            print('no %s samples left to evaluate' % p)
+            continue
 
-        layer_results = evaluate(model, x, y, names,
+        layer_results = evaluate(*predictions,
                                  group_patches=group_patches,
                                  group_recaptures=group_recaptures,
                                  max_patches=max_patches)
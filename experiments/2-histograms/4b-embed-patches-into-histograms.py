@@ -27,6 +27,8 @@ from sklearn.preprocessing import LabelEncoder
 
 from keras.preprocessing.image import load_img, img_to_array
 
+from connoisseur.utils.image import list_label_folders
+
 ex = Experiment('embed-patches-into-2-histograms')
 
 
@@ -40,7 +42,7 @@ def config():
 
 def load_data(directory):
     X, y, names = [], [], []
-    labels = sorted(os.listdir(directory))
+    labels = list_label_folders(directory)
 
     if not labels:
         raise ValueError('No labels detected. Perhaps the pointed directory is wrong: %s'
@@ -20,6 +20,7 @@ from sklearn.externals import joblib
 
 from connoisseur.datasets import group_by_paintings
 from connoisseur.fusion import Fusion, strategies
+from connoisseur.utils import RaggedArray
 
 matplotlib.use('agg')
 
@@ -78,7 +79,7 @@ def evaluate(model, x, y, names,
         labels, p, y, names = group_by_paintings(labels, p, y, names=names, max_patches=max_patches)
         y = np.asarray([_y[0] for _y in y])
 
-        patches = p.shape[1] if len(p.shape) > 1 else 'all'
+        patches = 'all' if isinstance(p, RaggedArray) else p.shape[1]
 
         for strategy_tag in ('sum', 'mean', 'farthest', 'most_frequent'):
             strategy = getattr(strategies, strategy_tag)
@@ -15,7 +15,8 @@ from sacred.utils import apply_backspaces_and_linefeeds
 
 from connoisseur import utils
 from connoisseur.models import build_siamese_model
-from connoisseur.utils.image import BalancedDirectoryPairsSequence
+from connoisseur.utils.image import BalancedDirectoryPairsSequence, list_label_folders
+from connoisseur.utils.splits import phase_sources
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -63,30 +64,35 @@ def config():
     validation_steps = None
     use_multiprocessing = False
     workers = 1
+    n_threads = 1
     initial_epoch = 0
     early_stop_patience = 30
     tensorboard_tag = 'train-top-network/'
+    split_file = None
 
 
 @ex.automain
 def run(_run, image_shape, data_dir, train_pairs, valid_pairs, classes,
         num_classes, architecture, weights, batch_size, last_base_layer, pooling, device, predictions_activation,
         opt_params, dropout_rate, resuming_ckpt, ckpt, steps_per_epoch, epochs, validation_steps, joints,
-        workers, use_multiprocessing, initial_epoch, early_stop_patience, use_gram_matrix, dense_layers,
-        embedding_units, limb_weights, trainable_limbs, tensorboard_tag):
+        workers, use_multiprocessing, n_threads, initial_epoch, early_stop_patience, use_gram_matrix, dense_layers,
+        embedding_units, limb_weights, trainable_limbs, tensorboard_tag, split_file):
     report_dir = _run.observers[0].dir
 
     if isinstance(classes, int):
-        classes = sorted(os.listdir(os.path.join(data_dir, 'train')))[:classes]
+        classes = list_label_folders(os.path.join(data_dir, 'train'))[:classes]
 
     g = ImageDataGenerator(horizontal_flip=True, vertical_flip=True, zoom_range=.2, rotation_range=.2,
                            height_shift_range=.2, width_shift_range=.2,
                            fill_mode='reflect', preprocessing_function=utils.get_preprocess_fn(architecture))
 
-    train_data = BalancedDirectoryPairsSequence(os.path.join(data_dir, 'train'), g, target_size=image_shape[:2],
-                                                pairs=train_pairs, classes=classes, batch_size=batch_size)
-    valid_data = BalancedDirectoryPairsSequence(os.path.join(data_dir, 'valid'), g, target_size=image_shape[:2],
-                                                pairs=valid_pairs, classes=classes, batch_size=batch_size)
+    (train_dir, train_split), (valid_dir, valid_split) = phase_sources(data_dir, split_file)
+    train_data = BalancedDirectoryPairsSequence(train_dir, g, target_size=image_shape[:2],
+                                                pairs=train_pairs, classes=classes, batch_size=batch_size,
+                                                n_threads=n_threads, **train_split)
+    valid_data = BalancedDirectoryPairsSequence(valid_dir, g, target_size=image_shape[:2],
+                                                pairs=valid_pairs, classes=classes, batch_size=batch_size,
+                                                n_threads=n_threads, **valid_split)
     if steps_per_epoch is None:
         steps_per_epoch = len(train_data)
     if validation_steps is None:
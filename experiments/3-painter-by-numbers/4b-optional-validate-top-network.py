@@ -18,7 +18,7 @@ from sklearn import metrics
 
 from connoisseur import utils
 from connoisseur.models import build_siamese_model
-from connoisseur.utils.image import BalancedDirectoryPairsSequence
+from connoisseur.utils.image import BalancedDirectoryPairsSequence, list_label_folders
 
 ex = Experiment('train-top-network')
 
@@ -67,7 +67,7 @@ def run(image_shape, data_dir, valid_pairs, classes,
         validation_steps, use_multiprocessing, use_gram_matrix, dense_layers,
         embedding_units, limb_weights, trainable_limbs):
     if isinstance(classes, int):
-        classes = sorted(os.listdir(os.path.join(data_dir, 'train')))[:classes]
+        classes = list_label_folders(os.path.join(data_dir, 'train'))[:classes]
 
     g = ImageDataGenerator(preprocessing_function=utils.get_preprocess_fn(architecture))
     valid_data = BalancedDirectoryPairsSequence(os.path.join(data_dir, 'valid'), g, target_size=image_shape[:2],
@@ -17,6 +17,7 @@ from connoisseur import get_preprocess_fn
 from connoisseur.datasets.painter_by_numbers import load_multiple_outputs
 from connoisseur.models import build_siamese_model
 from connoisseur.utils.image import BalancedDirectoryPairsMultipleOutputsSequence
+from connoisseur.utils.splits import phase_sources
 
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -66,6 +67,7 @@ def config():
     workers = 8
     initial_epoch = 0
     early_stop_patience = 100
+    split_file = None
 
     outputs_meta = [
         dict(n='artist', u=1584, e=2048, j='squared_diferences', a='softmax', l='binary_crossentropy', m='accuracy'),
@@ -81,7 +83,7 @@ def run(_run, image_shape, train_info, data_dir, train_pairs, valid_pairs, train
         opt_params, dropout_rate, resuming_ckpt, ckpt, steps_per_epoch, epochs,
         validation_steps, workers, use_multiprocessing, initial_epoch, early_stop_patience, use_gram_matrix,
         dense_layers,
-        limb_weights, trainable_limbs, outputs_meta):
+        limb_weights, trainable_limbs, outputs_meta, split_file):
     report_dir = _run.observers[0].dir
 
     print('reading train-info...')
@@ -97,21 +99,23 @@ def run(_run, image_shape, train_info, data_dir, train_pairs, valid_pairs, train
         fill_mode='reflect',
         preprocessing_function=get_preprocess_fn(architecture))
 
+    (train_dir, train_split), (valid_dir, valid_split) = phase_sources(data_dir, split_file)
+
     print('loading train meta-data...')
     train_data = BalancedDirectoryPairsMultipleOutputsSequence(
-        os.path.join(data_dir, 'train'), outputs, name_map, g,
+        train_dir, outputs, name_map, g,
         batch_size=batch_size, target_size=image_shape[:2],
         subdirectories=subdirectories,
         shuffle=train_shuffle,
-        pairs=train_pairs)
+        pairs=train_pairs, **train_split)
 
     print('loading valid meta-data...')
     valid_data = BalancedDirectoryPairsMultipleOutputsSequence(
-        os.path.join(data_dir, 'valid'), outputs, name_map, g,
+        valid_dir, outputs, name_map, g,
         batch_size=batch_size, target_size=image_shape[:2],
         subdirectories=subdirectories,
         shuffle=valid_shuffle,
-        pairs=valid_pairs)
+        pairs=valid_pairs, **valid_split)
 
     with tf.device(device):
         print('building...')
@@ -24,6 +24,7 @@ from sacred.utils import apply_backspaces_and_linefeeds
 
 from connoisseur.models import build_gram_model
 from connoisseur.utils import get_preprocess_fn
+from connoisseur.utils.image import list_label_folders
 
 ex = Experiment('train-gram-network')
 
@@ -107,7 +108,7 @@ def run(_run, image_shape, data_dir, train_shuffle, dataset_train_seed, valid_sh
         preprocessing_function=get_preprocess_fn(architecture))
 
     if isinstance(classes, int):
-        classes = sorted(os.listdir(os.path.join(data_dir, 'train')))[:classes]
+        classes = list_label_folders(os.path.join(data_dir, 'train'))[:classes]
 
     train_data = g.flow_from_directory(
         os.path.join(data_dir, 'train'),
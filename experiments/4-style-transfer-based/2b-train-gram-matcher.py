@@ -23,7 +23,7 @@ from sacred.utils import apply_backspaces_and_linefeeds
 
 from connoisseur.models import build_siamese_gram_model
 from connoisseur.utils import get_preprocess_fn, contrastive_loss
-from connoisseur.utils.image import BalancedDirectoryPairsSequence
+from connoisseur.utils.image import BalancedDirectoryPairsSequence, list_label_folders
 
 ex = Experiment('train-gram-network')
 
@@ -103,7 +103,7 @@ def run(_run, image_shape, data_dir, train_pairs, valid_pairs,
         preprocessing_function=get_preprocess_fn(architecture))
 
     if isinstance(classes, int):
-        classes = sorted(os.listdir(os.path.join(data_dir, 'train')))[:classes]
+        classes = list_label_folders(os.path.join(data_dir, 'train'))[:classes]
 
     train_data = BalancedDirectoryPairsSequence(os.path.join(data_dir, 'train'), g, target_size=image_shape[:2],
                                                 pairs=train_pairs, classes=classes, batch_size=batch_size)
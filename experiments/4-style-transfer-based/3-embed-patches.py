@@ -11,9 +11,7 @@ Licence: MIT License 2016 (c)
 """
 
 import os
-import pickle
 
-import numpy as np
 import tensorflow as tf
 from keras import backend as K
 from keras import layers
@@ -21,8 +19,10 @@ from keras.engine import Model
 from keras.preprocessing.image import ImageDataGenerator
 from sacred import Experiment
 
+from connoisseur.datasets import EmbeddingsWriter, is_columnar_data
 from connoisseur.models import build_gram_model
 from connoisseur.utils import gram_matrix, get_preprocess_fn
+from connoisseur.utils.image import Prefetcher, flow_from_patches
 
 ex = Experiment('embed-patches')
 
@@ -46,10 +46,10 @@ def config():
     ckpt_file = '/work/pbn/gram/1/weights.hdf5'
     pooling = 'avg'
     override = False
+    prefetch_depth = 4
     last_base_layer = None
     include_base_top = False
     include_top = False
-    embedded_files_max_size = 5 * 1024 ** 3
     num_classes = 1483
     predictions_activation = 'softmax'
     dense_layers = []
@@ -65,8 +65,7 @@ def config():
 def run(dataset_seed, image_shape, batch_size, device, data_dir, output_dir,
         phases, architecture, base_layers, predictions_activation,
         ckpt_file, weights, pooling, num_classes,
-        dense_layers, override,
-        embedded_files_max_size, selected_layers):
+        dense_layers, override, prefetch_depth, selected_layers):
     os.makedirs(output_dir, exist_ok=True)
 
     with tf.device(device):
@@ -92,8 +91,7 @@ def run(dataset_seed, image_shape, batch_size, device, data_dir, output_dir,
 
     for phase in phases:
         phase_data_dir = os.path.join(data_dir, phase)
-        output_file_name = os.path.join(output_dir, phase + '.%i.pickle')
-        already_embedded = os.path.exists(output_file_name % 0)
+        already_embedded = is_columnar_data(output_dir, phase)
         phase_exists = os.path.exists(phase_data_dir)
 
         if already_embedded and not override or not phase_exists:
@@ -101,54 +99,36 @@ def run(dataset_seed, image_shape, batch_size, device, data_dir, output_dir,
             continue
 
         # Shuffle must always be off in order to keep names consistent.
-        data = g.flow_from_directory(phase_data_dir,
-                                     target_size=image_shape[:2],
-                                     class_mode='sparse',
-                                     batch_size=batch_size, shuffle=False,
-                                     seed=dataset_seed)
+        data = Prefetcher(flow_from_patches(g, phase_data_dir,
+                                            target_size=image_shape[:2],
+                                            class_mode='sparse',
+                                            batch_size=batch_size, shuffle=False,
+                                            seed=dataset_seed),
+                          depth=prefetch_depth, epochs=1)
         print('transforming %i %s samples from %s' % (data.n, phase, phase_data_dir))
-        part_id = 0
         samples_seen = 0
         displayed_once = False
 
-        while samples_seen < data.n:
-            z, y = {n: [] for n in selected_layers}, []
-            chunk_size = 0
-            chunk_start = samples_seen
-
-            while chunk_size < embedded_files_max_size and samples_seen < data.n:
+        with data, EmbeddingsWriter(output_dir, phase, data.filenames) as writer:
+            while samples_seen < data.n:
                 _x, _y = next(data)
 
                 outputs = model.predict_on_batch(_x)
                 if not isinstance(outputs, list):
                     outputs = [outputs]
 
-                chunk_size += sum(o.nbytes for o in outputs)
-
-                for l, o in zip(selected_layers, outputs):
-                    z[l].append(o)
-
-                y.append(_y)
+                writer.write(samples_seen, dict(zip(selected_layers, outputs)), _y)
                 samples_seen += _x.shape[0]
                 chunk_p = int(100 * (samples_seen / data.n))
 
                 if chunk_p % 10 == 0:
                     if not displayed_once:
-                        print('\n%i%% (shape=%s, size=%.2f MB)'
-                              % (chunk_p, _x.shape, chunk_size / 1024 ** 2),
+                        print('\n%i%% (shape=%s)' % (chunk_p, _x.shape),
                               flush=True, end='')
                         displayed_once = True
                 else:
                     displayed_once = False
                     print('.', end='')
 
-            for layer in selected_layers:
-                z[layer] = np.concatenate(z[layer])
-
-            with open(output_file_name % part_id, 'wb') as f:
-                pickle.dump({'data': z,
-                             'target': np.concatenate(y),
-                             'names': np.asarray(data.filenames[chunk_start: samples_seen])},
-                            f, pickle.HIGHEST_PROTOCOL)
-            part_id += 1
+        print('\nwaited %.1fs for %i/%i batches' % (data.stall_time, data.stalls, data.batches))
     print('done.')
@@ -15,7 +15,7 @@ from sacred.utils import apply_backspaces_and_linefeeds
 
 from connoisseur import utils
 from connoisseur.models import build_siamese_gram_model
-from connoisseur.utils.image import BalancedDirectoryPairsSequence
+from connoisseur.utils.image import BalancedDirectoryPairsSequence, list_label_folders
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -80,7 +80,7 @@ def run(_run, image_shape, data_dir, train_pairs, valid_pairs, classes,
     report_dir = _run.observers[0].dir
 
     if isinstance(classes, int):
-        classes = sorted(os.listdir(os.path.join(data_dir, 'train')))[:classes]
+        classes = list_label_folders(os.path.join(data_dir, 'train'))[:classes]
 
     g = ImageDataGenerator(horizontal_flip=True, vertical_flip=True, zoom_range=.2, rotation_range=.2,
                            height_shift_range=.2, width_shift_range=.2,
@@ -0,0 +1,75 @@
+import hashlib
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from connoisseur.utils import download as d
+
+CONTENT = os.urandom(200 * 1024 + 17)
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    """Serves `CONTENT`, accepting Range requests. While `server.cut` is
+    set, transfers are interrupted halfway through."""
+
+    def do_HEAD(self):
+        self._respond(body=False)
+
+    def do_GET(self):
+        self._respond(body=True)
+
+    def _respond(self, body):
+        start, end = 0, len(CONTENT)
+        m = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if m:
+            start, end = int(m.group(1)), int(m.group(2) or end - 1) + 1
+
+        self.send_response(206 if m else 200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start))
+        if m:
+            self.send_header('Content-Range', 'bytes %i-%i/%i' % (start, end - 1, len(CONTENT)))
+        self.end_headers()
+
+        if body:
+            data = CONTENT[start:end]
+            self.wfile.write(data[:len(data) // 2] if self.server.cut else data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    s = ThreadingHTTPServer(('127.0.0.1', 0), _RangeHandler)
+    s.cut = True
+    threading.Thread(target=s.serve_forever, daemon=True).start()
+    yield s
+    s.shutdown()
+    s.server_close()
+
+
+@pytest.mark.parametrize('n_connections', [1, 3])
+def test_interrupted_download_is_resumed(server, tmpdir, monkeypatch, n_connections):
+    monkeypatch.setattr(d, 'CHUNK_SIZE', 4096)
+    url = 'http://127.0.0.1:%i/dataset.zip' % server.server_address[1]
+    file_name = str(tmpdir.join('dataset.zip'))
+    expected_hash = hashlib.md5(CONTENT).hexdigest()
+
+    with pytest.raises(RuntimeError, match='incomplete segment'):
+        d.download(url, file_name, n_connections=n_connections, expected_hash=expected_hash)
+
+    parts = [d._part_file_name(file_name, *p) for p in d._existing_parts(file_name)]
+    assert len(parts) == n_connections
+    assert all(os.path.getsize(p) > 0 for p in parts)
+    assert not os.path.exists(file_name)
+
+    server.cut = False
+    d.download(url, file_name, n_connections=n_connections, expected_hash=expected_hash)
+
+    with open(file_name, 'rb') as f:
+        assert f.read() == CONTENT
+    assert not d._existing_parts(file_name)